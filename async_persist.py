@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- encoding: UTF-8 -*-
+
+# Copyright 2016 Eddie Antonio Santos <easantos@ualberta.ca>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Look-ups from persist for asyncio code. Queries run on a bounded pool of
+threads, each with its own read-only connection, so they never block the
+event loop.
+
+Usage:
+    async_persist.py [sha...]
+
+Looks up the SHAs concurrently, or counts every commit, as a stream, if
+there are none.
+
+>>> print(run_in_subprocess(), end='')
+0 commits
+>>> print(run_in_subprocess('0' * 40), end='')
+0000000000000000000000000000000000000000 not found
+"""
+
+import asyncio
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import persist
+
+
+# Threads (and therefore connections) that run queries.
+WORKERS = int(os.getenv('ASYNC_PERSIST_WORKERS', 4))
+
+# Streamed rows are sent to the event loop this many at a time...
+CHUNK_SIZE = 256
+# ...and at most this many chunks wait for the consumer, before the query
+# waits too.
+MAX_CHUNKS = 8
+
+
+class AsyncPersist(object):
+    """
+    Coroutine versions of persist's look-ups. Commits are fully loaded in
+    the worker threads; nothing is loaded lazily on the event loop.
+    """
+
+    def __init__(self, workers=WORKERS, chunk_size=CHUNK_SIZE,
+                 max_chunks=MAX_CHUNKS):
+        self.chunk_size = chunk_size
+        self.max_chunks = max_chunks
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='persist',
+                                            initializer=persist.set_readonly)
+
+    async def fetch_commit(self, repo=None, sha=None):
+        return await self._run(persist.fetch_commit, repo, sha)
+
+    async def fetch_commits_by_repo(self, repo_name, valid_only=False,
+                                    autogen=False):
+        """
+        Returns a list of the repository's raw commits.
+        """
+        return await self._run(lambda: list(persist.fetch_commits_by_repo(
+            repo_name, valid_only=valid_only, autogen=autogen)))
+
+    def fetch_commits(self, autogen=False, valid_only=False):
+        """
+        Asynchronously iterates over all fully-processed commits.
+        """
+        return self._stream(persist.fetch_commits, autogen=autogen,
+                            valid_only=valid_only)
+
+    async def _run(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, function, *args)
+
+    async def _stream(self, function, **kwargs):
+        """
+        Iterates over a persist generator in a worker thread. The worker
+        waits whenever max_chunks chunks are waiting for the consumer.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=self.max_chunks)
+        stopped = threading.Event()
+
+        def put(item):
+            # Blocks the worker thread (never the loop) while the queue is
+            # full. Once the consumer stops, nothing more is sent.
+            if not stopped.is_set():
+                asyncio.run_coroutine_threadsafe(queue.put(item),
+                                                 loop).result()
+
+        def produce():
+            chunk = []
+            try:
+                for item in function(**kwargs):
+                    if stopped.is_set():
+                        return
+                    chunk.append(item)
+                    if len(chunk) >= self.chunk_size:
+                        put(chunk)
+                        chunk = []
+                put(chunk)
+            except Exception as error:
+                put(error)
+            finally:
+                put(None)
+
+        producer = loop.run_in_executor(self._executor, produce)
+        try:
+            while True:
+                chunk = await queue.get()
+                if chunk is None:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                for item in chunk:
+                    yield item
+        finally:
+            # Stop the worker. It puts at most the chunk it's putting now,
+            # so making room once is enough to unblock it.
+            stopped.set()
+            while not queue.empty():
+                queue.get_nowait()
+            await producer
+
+    async def close(self):
+        await asyncio.get_running_loop().run_in_executor(
+            None, self._executor.shutdown)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+async def look_up(shas):
+    """
+    Prints the commits with the given SHAs, or the number of commits.
+    """
+    async with AsyncPersist() as database:
+        if not shas:
+            count = 0
+            async for _commit in database.fetch_commits():
+                count += 1
+            print(count, 'commits')
+
+        async def look_up_one(sha):
+            try:
+                return await database.fetch_commit(sha=sha)
+            except KeyError:
+                return sha + ' not found'
+
+        for result in await asyncio.gather(*map(look_up_one, shas)):
+            print(result)
+
+
+def run_in_subprocess(*shas):
+    """
+    Runs this script on a new, empty database; returns its output.
+    """
+    import subprocess
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as directory:
+        environment = dict(os.environ, COMMIT_DATABASE=os.path.join(
+            directory, 'commits.sqlite'))
+        return subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__)] + list(shas),
+            env=environment).decode('UTF-8')
+
+
+if __name__ == '__main__':
+    persist.init_db()
+    asyncio.run(look_up(sys.argv[1:]))
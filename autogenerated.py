@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- encoding: UTF-8 -*-
+
+# Copyright 2016 Eddie Antonio Santos <easantos@ualberta.ca>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Recognizes autogenerated commit messages from templates of tokens.
+"""
+
+import os
+
+
+TEMPLATES_FILENAME = os.getenv(
+    'AUTOGENERATED_MESSAGES',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 'autogenerated_messages.txt'))
+
+# Special tokens in templates.
+ANY_TOKEN = '*'
+REST_OF_MESSAGE = '...'
+EMPTY_TOKEN = '""'
+
+
+class _Node(object):
+    __slots__ = ('children', 'any_token', 'is_end', 'is_prefix')
+
+    def __init__(self):
+        self.children = {}
+        self.any_token = None
+        self.is_end = False
+        self.is_prefix = False
+
+
+class TemplateMatcher(object):
+    """
+    A trie of message templates, that matches a sequence of tokens in one
+    pass, stopping as soon as the tokens diverge from every template.
+
+    >>> matcher = TemplateMatcher([
+    ...     'maven-release-plugin prepare release VERSION-NUMBER',
+    ...     'gradle release plugin * ...',
+    ...     'git-svn-id ""',
+    ... ])
+    >>> matcher.match(['maven-release-plugin', 'prepare', 'release',
+    ...                'VERSION-NUMBER'])
+    True
+    >>> matcher.match(['maven-release-plugin', 'prepare', 'release'])
+    False
+    >>> 'gradle release plugin - pre tag commit' in matcher
+    True
+    >>> 'gradle release plugin' in matcher
+    False
+    >>> 'git-svn-id ' in matcher
+    True
+
+    It stops reading as soon as nothing can match:
+    >>> tokens = iter(['fixed', 'ISSUE-NUMBER', 'in', 'FILE-PATTERN'])
+    >>> matcher.match(tokens)
+    False
+    >>> next(tokens)
+    'ISSUE-NUMBER'
+    """
+
+    def __init__(self, templates=()):
+        self._root = _Node()
+        self.templates = []
+        for template in templates:
+            self.add(template)
+
+    def add(self, template):
+        tokens = template.split(' ')
+        node = self._root
+        for position, token in enumerate(tokens):
+            if token == REST_OF_MESSAGE:
+                if position != len(tokens) - 1:
+                    raise ValueError('%r must end the template: %r' %
+                                     (REST_OF_MESSAGE, template))
+                node.is_prefix = True
+                break
+            elif token == ANY_TOKEN:
+                if node.any_token is None:
+                    node.any_token = _Node()
+                node = node.any_token
+            else:
+                if token == EMPTY_TOKEN:
+                    token = ''
+                node = node.children.setdefault(token, _Node())
+        else:
+            node.is_end = True
+        self.templates.append(template)
+
+    def match(self, tokens):
+        """
+        Does the sequence of tokens match any template?
+        """
+        active = [self._root]
+        for token in tokens:
+            following = []
+            for node in active:
+                if node.is_prefix:
+                    return True
+                child = node.children.get(token)
+                if child is not None:
+                    following.append(child)
+                if node.any_token is not None:
+                    following.append(node.any_token)
+            if not following:
+                return False
+            active = following
+
+        return any(node.is_end or node.is_prefix for node in active)
+
+    def __contains__(self, tokens_as_string):
+        return self.match(tokens_as_string.split(' '))
+
+    def __len__(self):
+        return len(self.templates)
+
+    def __repr__(self):
+        return '<{} templates={}>'.format(self.__class__.__name__, len(self))
+
+    @classmethod
+    def load(cls, filename=TEMPLATES_FILENAME):
+        """
+        Loads templates from a file: one per line; blank lines and lines
+        starting with '#' are ignored.
+        """
+        with open(filename, encoding='UTF-8') as template_file:
+            lines = (line.strip() for line in template_file)
+            return cls(line for line in lines
+                       if line and not line.startswith('#'))
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- encoding: UTF-8 -*-
+
+# Copyright 2016 Eddie Antonio Santos <easantos@ualberta.ca>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compares the throughput of the token classifiers and token cleaners, and
+checks that the fast paths give identical output on a fuzz corpus.
+
+Usage:
+    bench_tokenize.py [messages.txt]
+
+Without a file, uses the messages from the tokenize() doctests.
+"""
+
+import doctest
+import random
+import re
+import string
+import sys
+import time
+import unicodedata
+
+import tokenize_commit
+from tokenize_commit import (clean_token, clean_token_unicode, tokenize,
+                             replace_special_token,
+                             replace_special_token_by_predicates)
+
+
+# Bits and pieces of commit messages, to make the fuzz corpus interesting.
+FRAGMENTS = (
+    list(string.ascii_letters + string.digits + string.punctuation) +
+    [' ', ' ', ' ', '\t', '\n', ';',
+     '#12', 'v1.2', '-rc1', 'http://', 'svn://', '.java', '.{h,cpp}',
+     '::', '()', '...', '[', ']', '`', '<a@b.c>', 'thrift-', 'Merge ',
+     '\u00e9', 'e\u0301', 'I\u0308', '\u00ab', '\u00bb', '\u201c',
+     '\u201d', '\u00bf', '\u4e2d', '\u2014', '\u00a0', '\x01']
+)
+
+
+def doctest_messages():
+    """
+    Yields every message that is tokenized in tokenize()'s doctests.
+    """
+    finder = doctest.DocTestFinder()
+    for test in finder.find(tokenize_commit.tokenize):
+        for example in test.examples:
+            match = re.match(r'tokenize\((.*)\)$', example.source.strip())
+            if match:
+                yield eval(match.group(1))
+
+
+def load_messages(filename):
+    with open(filename, encoding='UTF-8') as message_file:
+        return [line.rstrip('\n') for line in message_file]
+
+
+def split_tokens(messages):
+    tokens = []
+    for message in messages:
+        cleaned = tokenize_commit.clean_front(message.lower())
+        tokens.extend(t for t in re.split(r'[\s;]+', cleaned) if t)
+    return tokens
+
+
+def throughput(classify, tokens, repeat=5):
+    """
+    Returns the best tokens/second out of several runs.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for token in tokens:
+            classify(token)
+        best = min(best, time.perf_counter() - start)
+    return len(tokens) / best
+
+
+def fuzz_corpus(size=20000, seed=2016):
+    """
+    Returns a reproducible list of random messages.
+    """
+    generator = random.Random(seed)
+    return [''.join(generator.choice(FRAGMENTS)
+                    for _ in range(generator.randint(0, 40)))
+            for _ in range(size)]
+
+
+def tokenize_reference(message):
+    """
+    tokenize(), without any fast paths.
+    """
+    ustring = unicodedata.normalize('NFC', message).lower()
+    cleaned = tokenize_commit.clean_front(ustring)
+    segments = re.split(r'[\s;]+', cleaned, flags=re.UNICODE)
+    return [replace_special_token_by_predicates(segment)
+            for segment in segments if segment]
+
+
+def check_fast_paths(messages):
+    """
+    Asserts that the ASCII fast paths match the full Unicode paths.
+    """
+    for message in messages:
+        assert tokenize(message) == tokenize_reference(message), message
+        for token in re.split(r'[\s;]+', message.lower()):
+            assert clean_token(token) == clean_token_unicode(token), token
+
+
+def compare(tokens):
+    mismatches = [t for t in tokens
+                  if replace_special_token(t) !=
+                  replace_special_token_by_predicates(t)]
+    assert not mismatches, mismatches
+
+    reference = throughput(replace_special_token_by_predicates, tokens)
+    compiled = throughput(replace_special_token, tokens)
+    print('{:>24}: {:12,.0f} tokens/s'.format('predicate chain', reference))
+    print('{:>24}: {:12,.0f} tokens/s'.format('compiled classifier',
+                                              compiled))
+    print('{:>24}: {:12.2f}x'.format('speed-up', compiled / reference))
+
+    ascii_tokens = [t for t in tokens if t.isascii()]
+    unicode_path = throughput(clean_token_unicode, ascii_tokens)
+    ascii_path = throughput(clean_token, ascii_tokens)
+    print('{:>24}: {:12,.0f} tokens/s'.format('clean_token (regex)',
+                                              unicode_path))
+    print('{:>24}: {:12,.0f} tokens/s'.format('clean_token (ASCII)',
+                                              ascii_path))
+    print('{:>24}: {:12.2f}x'.format('speed-up', ascii_path / unicode_path))
+
+
+def compare_token_cache(messages):
+    tokenize_commit.configure_token_cache(0)
+    uncached = throughput(tokenize, messages)
+    tokenize_commit.configure_token_cache()
+    cached = throughput(tokenize, messages)
+    print('{:>24}: {:12,.0f} messages/s'.format('tokenize (no cache)',
+                                                uncached))
+    print('{:>24}: {:12,.0f} messages/s'.format('tokenize (cache)', cached))
+    print('{:>24}: {:12.2f}x'.format('speed-up', cached / uncached))
+    print('{:>24}: {!r}'.format('cache', tokenize_commit.token_cache_stats()))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        messages = load_messages(sys.argv[1])
+    else:
+        # Repeat the small corpus so the timings are stable.
+        messages = list(doctest_messages()) * 200
+
+    check_fast_paths(messages + fuzz_corpus())
+    compare(split_tokens(messages))
+    compare_token_cache(messages)
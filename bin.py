@@ -22,6 +22,7 @@ import pickle
 from collections import namedtuple, Counter
 
 import persist
+from commit import prime_message_cache
 
 
 class Bin(object):
@@ -90,6 +91,8 @@ class Bin(object):
         self._commits.append(commit)
 
     def count_commits(self):
+        # Look up (or tokenize) every message at once, not one at a time.
+        prime_message_cache(self)
         return Counter(c.tokens_as_string for c in self)
 
     def __getitem__(self, index):
@@ -162,7 +165,7 @@ def freedman_diaconis_rule(seq, key=identity):
 
 def create_bins(autogen=False):
 
-    commits = list(persist.fetch_commits(autogen))
+    commits = list(persist.fetch_commits(autogen, lazy=True))
     assert len(commits) >= 2
 
     def by_xentropy(commit):
@@ -198,6 +201,7 @@ def export_csv(filename, values):
 
 
 if __name__ in ('__main__', '__console__'):
+    persist.init_db()
     bins = load_bins()
 
     # Sort bins by size.
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- encoding: UTF-8 -*-
+
+# Copyright 2016 Eddie Antonio Santos <easantos@ualberta.ca>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import division
+
+import sys
+from collections import OrderedDict, namedtuple
+
+
+class CacheStats(namedtuple(..., 'hits misses evictions size maxsize '
+                                 'bytes max_bytes')):
+    __slots__ = ()
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+def sizeof_entry(key, value):
+    """
+    Approximate memory used by one entry: the key and the value themselves.
+    """
+    return sys.getsizeof(key) + sys.getsizeof(value)
+
+
+class LRUCache(object):
+    """
+    A bounded mapping that evicts the least-recently used entries, and counts
+    its hits, misses, and evictions.
+
+    >>> cache = LRUCache(maxsize=2)
+    >>> cache['a'] = 1
+    >>> cache['b'] = 2
+    >>> cache.get('a')
+    1
+    >>> cache['c'] = 3
+    >>> cache.get('b') is None
+    True
+    >>> stats = cache.stats
+    >>> stats.hits, stats.misses, stats.evictions, stats.size
+    (1, 1, 1, 2)
+
+    A maxsize of zero disables the cache; None makes it unbounded.
+    >>> cache = LRUCache(maxsize=0)
+    >>> cache['a'] = 1
+    >>> len(cache)
+    0
+
+    It can also be bounded by (approximate) memory use, in bytes:
+    >>> cache = LRUCache(max_bytes=300, sizeof=lambda key, value: 100)
+    >>> for key in 'abcd':
+    ...     cache[key] = key
+    >>> sorted(cache.keys()), cache.bytes
+    (['b', 'c', 'd'], 300)
+
+    Use it as a context manager to empty it when done:
+    >>> with cache:
+    ...     cache['e'] = 'e'
+    >>> len(cache)
+    0
+    """
+
+    def __init__(self, maxsize=None, max_bytes=None, sizeof=None):
+        assert maxsize is None or maxsize >= 0
+        assert max_bytes is None or max_bytes >= 0
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        if sizeof is None and max_bytes is not None:
+            sizeof = sizeof_entry
+        self._sizeof = sizeof
+        # Maps keys to (value, size) pairs, least-recently used first.
+        self._entries = OrderedDict()
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, default=None):
+        try:
+            value, _size = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        if self.maxsize == 0 or self.max_bytes == 0:
+            return
+
+        size = self._sizeof(key, value) if self._sizeof else 0
+        if key in self._entries:
+            self.bytes -= self._entries.pop(key)[1]
+        self._entries[key] = (value, size)
+        self.bytes += size
+
+        while ((self.maxsize is not None and
+                len(self._entries) > self.maxsize) or
+               (self.max_bytes is not None and self.bytes > self.max_bytes)):
+            _key, (_value, evicted_size) = self._entries.popitem(last=False)
+            self.bytes -= evicted_size
+            self.evictions += 1
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def keys(self):
+        return self._entries.keys()
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.clear()
+
+    @property
+    def stats(self):
+        return CacheStats(hits=self.hits, misses=self.misses,
+                          evictions=self.evictions, size=len(self),
+                          maxsize=self.maxsize, bytes=self.bytes,
+                          max_bytes=self.max_bytes)
+
+    def __repr__(self):
+        return '<{} {!r}>'.format(self.__class__.__name__, self.stats)
@@ -16,39 +16,161 @@
 
 from __future__ import division
 
+import hashlib
+import os
 from collections import namedtuple
+from contextlib import contextmanager
 from math import log
+from string import ascii_uppercase
 
-import langid
-
-from tokenize_commit import tokenize
+from autogenerated import TemplateMatcher
+from cache import LRUCache, sizeof_entry
+from parallel import parallel_map
+from tokenize_commit import TOKENIZER_VERSION, tokenize, iter_tokenize_many
 
 
 # Would use weakref but we can't hold a reference to a string, or a tuple, or
 # anything useful.
-# Let's tear through our memory instead.
-_MESSAGE_CACHE = {}
+# So keep as many tokenized messages as fit in MESSAGE_CACHE_BYTES instead.
+MESSAGE_CACHE_BYTES = int(os.getenv('MESSAGE_CACHE_BYTES', 256 * 2**20))
+_MESSAGE_CACHE = LRUCache(max_bytes=MESSAGE_CACHE_BYTES,
+                          sizeof=sizeof_entry)
+
+
+def configure_message_cache(max_bytes=MESSAGE_CACHE_BYTES):
+    """
+    Replaces the message cache with an empty one with the given memory
+    budget, in bytes. A budget of zero disables the cache; None makes it
+    unbounded.
+    """
+    global _MESSAGE_CACHE
+    _MESSAGE_CACHE = LRUCache(max_bytes=max_bytes, sizeof=sizeof_entry)
+
+
+def message_cache_stats():
+    """
+    Returns the hits, misses, evictions, size, and bytes used by the message
+    cache.
+    """
+    return _MESSAGE_CACHE.stats
+
+
+def clear_message_cache():
+    _MESSAGE_CACHE.clear()
+
+
+@contextmanager
+def scoped_message_cache():
+    """
+    Empties the message cache when done, e.g., after each repository:
+
+        for repo in repos:
+            with scoped_message_cache():
+                ...
+    """
+    try:
+        yield _MESSAGE_CACHE
+    finally:
+        clear_message_cache()
+
+
+# A function (repo, sha) -> tokens_as_string, that raises KeyError for
+# commits it does not know, and a function that takes many (repo, sha) and
+# returns a dictionary of the ones it knows. persist sets these to its tokens
+# table.
+_TOKEN_STORE = None
+_TOKEN_STORE_MANY = None
+
+
+def set_token_store(lookup, lookup_many=None):
+    """
+    Tells commits where to look for persisted tokens, before tokenizing.
+    """
+    global _TOKEN_STORE, _TOKEN_STORE_MANY
+    _TOKEN_STORE = lookup
+    _TOKEN_STORE_MANY = lookup_many
+
+
+# Language identification is slow, so remember (lang, confidence) by SHA.
+LANGUAGE_CACHE_SIZE = int(os.getenv('LANGUAGE_CACHE_SIZE', 2**20))
+_LANGUAGE_CACHE = LRUCache(maxsize=LANGUAGE_CACHE_SIZE)
+
+# A function (repo, sha) -> (lang, confidence), that raises KeyError for
+# commits it does not know. persist sets this to its commit_lang table.
+_LANGUAGE_STORE = None
+
+
+def set_language_store(lookup):
+    """
+    Tells commits where to look for persisted languages, before classifying.
+    """
+    global _LANGUAGE_STORE
+    _LANGUAGE_STORE = lookup
 
 
 # These are well-known autogenerated messages, collected from
-# commit statistics.
-AUTOGENERATED_MESSAGES = {
-    'PROJECT-ISSUE build version advanced to BUILD-VERSION git-svn-id URL UUID',
-    'URL UUID',
-    'build version advanced to ${maven.dev.version',
-    'gradle release plugin - new version commit VERSION-NUMBER',
-    'gradle release plugin - pre tag commit VERSION-NUMBER',
-    'gradle release plugin - pre tag commit VERSION-NUMBER',
-    'maven-release-plugin prepare for next development iteration git-svn-id ',
-    'maven-release-plugin prepare for next development iteration git-svn-id URL UUID',
-    'maven-release-plugin prepare for next development iteration',
-    'maven-release-plugin prepare release FILE-PATTERN',
-    'maven-release-plugin prepare release RELEASE-IDENTIFIER',
-    'maven-release-plugin prepare release VERSION-NUMBER',
-    'maven-release-plugin rollback the release of RELEASE-IDENTIFIER',
-    'release]prepare for next development iteration',
-    'release]prepare release RELEASE-IDENTIFIER',
-}
+# commit statistics. See autogenerated_messages.txt.
+AUTOGENERATED_MESSAGES = TemplateMatcher.load()
+
+
+def _flags_version():
+    """
+    Flags depend on the tokenizer, and on the autogenerated message
+    templates: any change to either changes this version.
+    """
+    digest = hashlib.sha1(TOKENIZER_VERSION.encode('UTF-8'))
+    for template in AUTOGENERATED_MESSAGES.templates:
+        digest.update(b'\n' + template.encode('UTF-8'))
+    return digest.hexdigest()[:16]
+
+
+# Identifies how Commit.flags were computed, for persisted flags.
+FLAGS_VERSION = _flags_version()
+
+
+# Bits of Commit.flags.
+FLAG_MERGE = 1 << 0
+FLAG_EMPTY = 1 << 1
+FLAG_AUTOGENERATED = 1 << 2
+FLAG_CANCELLED = 1 << 3
+FLAG_ENGLISH = 1 << 4
+ALL_FLAGS = (FLAG_MERGE | FLAG_EMPTY | FLAG_AUTOGENERATED | FLAG_CANCELLED |
+             FLAG_ENGLISH)
+
+
+def flags_are_valid(flags, autogen=False):
+    """
+    Whether a commit with these flags is valid, i.e., Commit.is_valid, or
+    Commit.is_valid_with_autogen when autogen is True.
+
+    >>> flags_are_valid(FLAG_ENGLISH)
+    True
+    >>> flags_are_valid(FLAG_ENGLISH | FLAG_AUTOGENERATED)
+    False
+    >>> flags_are_valid(FLAG_ENGLISH | FLAG_AUTOGENERATED, autogen=True)
+    True
+    >>> flags_are_valid(0, autogen=True)
+    False
+    """
+    if autogen:
+        return (not flags & (FLAG_CANCELLED | FLAG_MERGE | FLAG_EMPTY) and
+                bool(flags & FLAG_ENGLISH))
+    return not flags & (FLAG_CANCELLED | FLAG_EMPTY | FLAG_MERGE |
+                        FLAG_AUTOGENERATED)
+
+
+def valid_flags(autogen=False, ignored=0):
+    """
+    Every possible value of Commit.flags of a valid commit, whatever the
+    ignored flags are.
+
+    >>> valid_flags()
+    (0, 16)
+    >>> valid_flags(ignored=FLAG_CANCELLED)
+    (0, 8, 16, 24)
+    """
+    return tuple(flags for flags in range(ALL_FLAGS + 1)
+                 if flags_are_valid(flags & ~ignored, autogen))
 
 
 class Commit(namedtuple(..., 'repo sha time message status perplexity')):
@@ -65,7 +187,7 @@ class Commit(namedtuple(..., 'repo sha time message status perplexity')):
 
     @property
     def is_autogenerated_message(self):
-        return self.tokens_as_string in AUTOGENERATED_MESSAGES
+        return AUTOGENERATED_MESSAGES.match(self.tokens_as_string.split(' '))
 
     @property
     def tokens(self):
@@ -99,25 +221,58 @@ class Commit(namedtuple(..., 'repo sha time message status perplexity')):
                 not self.is_merge and
                 not self.is_autogenerated_message)
 
+    @property
+    def flags(self):
+        """
+        Everything that decides validity, as a bitmask of FLAG_* values.
+        """
+        return ((FLAG_MERGE if self.is_merge else 0) |
+                (FLAG_EMPTY if self.is_empty else 0) |
+                (FLAG_AUTOGENERATED if self.is_autogenerated_message else 0) |
+                (FLAG_CANCELLED if self.build_was_cancelled else 0) |
+                (FLAG_ENGLISH if self.is_plausibly_english else 0))
+
     @property
     def tokens_as_string(self):
-        try:
-            return _MESSAGE_CACHE[self.sha]
-        except KeyError:
-            message = ' '.join(self.tokens)
-            _MESSAGE_CACHE[self.sha] = message
+        message = _MESSAGE_CACHE.get(self.sha)
+        if message is not None:
             return message
 
+        if _TOKEN_STORE is not None:
+            try:
+                message = _TOKEN_STORE(self.repo, self.sha)
+            except KeyError:
+                pass
+        if message is None:
+            message = ' '.join(self.tokens)
+
+        _MESSAGE_CACHE[self.sha] = message
+        return message
+
     @property
     def is_empty(self):
         return len(self.tokens_as_string.strip()) == 0
 
     @property
     def most_likely_language(self):
-        from string import ascii_uppercase
-        without_special_tokens = ' '.join(t for t in self.tokens
-                                          if t[:1] not in ascii_uppercase)
-        return langid.classify(without_special_tokens)
+        language = _LANGUAGE_CACHE.get(self.sha)
+        if language is not None:
+            return language
+
+        if _LANGUAGE_STORE is not None:
+            try:
+                language = _LANGUAGE_STORE(self.repo, self.sha)
+            except KeyError:
+                pass
+        if language is None:
+            language = classify_language(self.text_for_language)
+
+        _LANGUAGE_CACHE[self.sha] = language
+        return language
+
+    @property
+    def text_for_language(self):
+        return text_for_language(self.tokens_as_string)
 
     @property
     def is_plausibly_english(self):
@@ -126,3 +281,165 @@ class Commit(namedtuple(..., 'repo sha time message status perplexity')):
 
         lang, _confidence = self.most_likely_language
         return lang == 'en'
+
+
+class LazyCommit(Commit):
+    """
+    A Commit whose message is only loaded when it is accessed: in place of
+    the message, it holds a function (repo, sha) -> message. Otherwise, it
+    behaves like the equivalent Commit, when indexed, iterated, compared,
+    hashed, printed, or pickled.
+
+    >>> commit = LazyCommit('a/b', '0' * 40, None, lambda repo, sha: 'Fix',
+    ...                     None, None)
+    >>> commit.message, commit[3], tuple(commit)[3]
+    ('Fix', 'Fix', 'Fix')
+    >>> commit == Commit('a/b', '0' * 40, None, 'Fix', None, None)
+    True
+    """
+    __slots__ = ()
+
+    @property
+    def message(self):
+        load = tuple.__getitem__(self, 3)
+        return load(self.repo, self.sha)
+
+    def to_commit(self):
+        return Commit(self.repo, self.sha, self.time, self.message,
+                      self.status, self.perplexity)
+
+    def __getitem__(self, index):
+        return self.to_commit()[index]
+
+    def __iter__(self):
+        return iter(self.to_commit())
+
+    def __eq__(self, other):
+        if isinstance(other, LazyCommit):
+            other = other.to_commit()
+        return self.to_commit() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.to_commit())
+
+    def __repr__(self):
+        return repr(self.to_commit())
+
+    def __reduce__(self):
+        return Commit, tuple(self.to_commit())
+
+
+class TokenizedCommit(namedtuple(..., Commit._fields + ('tokens_as_string',)),
+                      Commit):
+    """
+    A Commit that holds its own tokens_as_string, so it never needs the
+    (bounded) message cache, nor the token store.
+
+    >>> commit = TokenizedCommit('a/b', '0' * 40, None, 'Fixed #22', None,
+    ...                          None, 'fixed ISSUE-NUMBER')
+    >>> commit.tokens_as_string, commit.is_empty
+    ('fixed ISSUE-NUMBER', False)
+    """
+    __slots__ = ()
+
+
+def remember_tokens_as_string(sha, tokens_as_string):
+    """
+    Caches tokens that were tokenized elsewhere (e.g., persisted tokens).
+    """
+    _MESSAGE_CACHE[sha] = tokens_as_string
+
+
+def prime_message_cache(commits, workers=None, stored=True):
+    """
+    Looks up the persisted tokens of every commit that is not yet in the
+    message cache, all at once, and tokenizes the rest in parallel, so that
+    later accesses to tokens_as_string are free. When stored is False, the
+    caller knows that no tokens are persisted for these commits, so the
+    token store is not asked.
+    """
+    pending = [commit for commit in commits
+               if commit.sha not in _MESSAGE_CACHE]
+    if pending and stored and _TOKEN_STORE_MANY is not None:
+        persisted = _TOKEN_STORE_MANY([(commit.repo, commit.sha)
+                                       for commit in pending])
+        for commit in pending:
+            tokens_as_string = persisted.get((commit.repo, commit.sha))
+            if tokens_as_string is not None:
+                _MESSAGE_CACHE[commit.sha] = tokens_as_string
+        pending = [commit for commit in pending
+                   if (commit.repo, commit.sha) not in persisted]
+    messages = (commit.message for commit in pending)
+    for commit, tokens in zip(pending,
+                              iter_tokenize_many(messages, workers=workers)):
+        _MESSAGE_CACHE[commit.sha] = ' '.join(tokens)
+
+
+def classify_language(text):
+    """
+    Returns the most likely (lang, confidence) of the text.
+    """
+    # langid (and NumPy) take a while to import; only import them if needed.
+    import langid
+    lang, confidence = langid.classify(text)
+    return lang, float(confidence)
+
+
+def text_for_language(tokens_as_string):
+    """
+    The tokens that langid should look at: no special tokens.
+
+    >>> text_for_language('fixed ISSUE-NUMBER in FILE-PATTERN')
+    'fixed in'
+    """
+    return ' '.join(t for t in tokens_as_string.split(' ')
+                    if t[:1] not in ascii_uppercase)
+
+
+def _classify_message(item):
+    """
+    Returns the (lang, confidence) of a message, tokenizing it first, unless
+    its tokens_as_string is given.
+    """
+    tokens_as_string, message = item
+    if tokens_as_string is None:
+        tokens_as_string = ' '.join(tokenize(message))
+    return classify_language(text_for_language(tokens_as_string))
+
+
+def classify_languages(commits, workers=None, stored=True):
+    """
+    Returns the most likely (lang, confidence) of every commit, in order.
+    Commits whose language is not known yet are tokenized (unless their
+    tokens are cached) and classified in parallel. When stored is False,
+    the caller knows that no language is persisted for these commits, so
+    the language store is not asked.
+    """
+    commits = list(commits)
+    languages = [None] * len(commits)
+
+    pending = []
+    for index, commit in enumerate(commits):
+        language = _LANGUAGE_CACHE.get(commit.sha)
+        if language is None and stored and _LANGUAGE_STORE is not None:
+            try:
+                language = _LANGUAGE_STORE(commit.repo, commit.sha)
+            except KeyError:
+                pass
+        if language is None:
+            pending.append(index)
+        else:
+            languages[index] = language
+
+    items = ((_MESSAGE_CACHE.get(commits[index].sha), commits[index].message)
+             for index in pending)
+    for index, language in zip(pending, parallel_map(_classify_message,
+                                                     items,
+                                                     workers=workers)):
+        _LANGUAGE_CACHE[commits[index].sha] = language
+        languages[index] = language
+
+    return languages
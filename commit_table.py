@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# -*- encoding: UTF-8 -*-
+
+# Copyright 2016 Eddie Antonio Santos <easantos@ualberta.ca>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A compact, column-oriented alternative to a list of Commits.
+"""
+
+import calendar
+import math
+from array import array
+from binascii import hexlify, unhexlify
+from datetime import datetime, timedelta
+
+from commit import Commit
+
+
+SHA_SIZE = 20
+EPOCH = datetime(1970, 1, 1)
+# Stands in for a missing time.
+NO_TIME = -2**63
+
+
+class Interner(object):
+    """
+    Gives every distinct name a small integer code, in order of first
+    appearance, and remembers the name of every code.
+
+    >>> repos = Interner()
+    >>> repos.code('a/b'), repos.code('c/d'), repos.code('a/b')
+    (0, 1, 0)
+    >>> repos.names
+    ['a/b', 'c/d']
+    """
+
+    def __init__(self, names=(), limit=None):
+        self.names = []
+        self.limit = limit
+        self._codes = {}
+        for name in names:
+            self.code(name)
+
+    def code(self, name):
+        try:
+            return self._codes[name]
+        except KeyError:
+            assert self.limit is None or len(self.names) < self.limit, \
+                'Too many names'
+            self._codes[name] = len(self.names)
+            self.names.append(name)
+            return self._codes[name]
+
+    def copy(self):
+        return self.__class__(self.names, limit=self.limit)
+
+    def __len__(self):
+        return len(self.names)
+
+
+class CommitTable(object):
+    """
+    Commits, stored column by column: repository IDs, binary SHAs, times
+    (seconds since the epoch), status codes, perplexities, and all of the
+    messages in one UTF-8 buffer, indexed by offsets. About 50 bytes per
+    commit, plus the message.
+
+    >>> table = CommitTable.from_commits([
+    ...     Commit('a/b', 'f75a283' * 5 + '00000', '2016-01-31 12:00:00',
+    ...            'Fixed #22', 'passed', 8.0),
+    ...     Commit('c/d', 'd670460b4b4aece5915caf5c68d12f560a9fe3e4',
+    ...            '2016-02-01 08:30:00', 'Naïve', 'failed', None),
+    ... ])
+    >>> len(table)
+    2
+    >>> table[1]
+    Commit(repo='c/d', sha='d670460b4b4aece5915caf5c68d12f560a9fe3e4', \
+time='2016-02-01 08:30:00', message='Naïve', status='failed', \
+perplexity=None)
+    >>> table[0].cross_entropy
+    3.0
+    >>> [c.repo for c in table.filter([False, True])]
+    ['c/d']
+    >>> first = table[:1]
+    >>> first.append(Commit('e/f', '0' * 40, None, '', None, None))
+    >>> len(first), len(table.repo_names)
+    (2, 2)
+    """
+
+    def __init__(self):
+        self.repos = Interner()
+        # Status codes must fit in a byte. Code 0 is no status.
+        self.statuses = Interner([None], limit=256)
+        self.repo_ids = array('I')
+        self.shas = bytearray()
+        self.times = array('q')
+        self.status_codes = array('B')
+        self.perplexities = array('d')
+        self.messages = bytearray()
+        self.message_offsets = array('Q', [0])
+
+    @property
+    def repo_names(self):
+        return self.repos.names
+
+    @property
+    def status_names(self):
+        return self.statuses.names
+
+    @classmethod
+    def from_commits(cls, commits):
+        table = cls()
+        for commit in commits:
+            table.append(commit)
+        return table
+
+    def append(self, commit):
+        self.repo_ids.append(self.repos.code(commit.repo))
+        assert len(commit.sha) == 2 * SHA_SIZE, commit.sha
+        self.shas += unhexlify(commit.sha)
+        self.times.append(to_epoch(commit.time))
+        self.status_codes.append(self.statuses.code(commit.status))
+        self.perplexities.append(float('nan') if commit.perplexity is None
+                                 else commit.perplexity)
+        self.messages += commit.message.encode('UTF-8')
+        self.message_offsets.append(len(self.messages))
+
+    def take(self, indices):
+        """
+        Returns a new table with only the rows at the given indices.
+        """
+        table = self.__class__()
+        # Copy the dictionaries, so that IDs and codes stay the same, but
+        # names added to one table don't change the other.
+        table.repos = self.repos.copy()
+        table.statuses = self.statuses.copy()
+
+        for index in indices:
+            table.repo_ids.append(self.repo_ids[index])
+            table.shas += self.shas[index * SHA_SIZE:(index + 1) * SHA_SIZE]
+            table.times.append(self.times[index])
+            table.status_codes.append(self.status_codes[index])
+            table.perplexities.append(self.perplexities[index])
+            start, end = self.message_offsets[index:index + 2]
+            table.messages += self.messages[start:end]
+            table.message_offsets.append(len(table.messages))
+        return table
+
+    def filter(self, mask):
+        """
+        Returns a new table with only the rows where the mask is true.
+        """
+        return self.take(index for index, keep in enumerate(mask) if keep)
+
+    def __len__(self):
+        return len(self.repo_ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.take(range(*index.indices(len(self))))
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+
+        start, end = self.message_offsets[index:index + 2]
+        perplexity = self.perplexities[index]
+        return Commit(
+            repo=self.repo_names[self.repo_ids[index]],
+            sha=hexlify(self.shas[index * SHA_SIZE:(index + 1) * SHA_SIZE])
+            .decode('ASCII'),
+            time=from_epoch(self.times[index]),
+            message=self.messages[start:end].decode('UTF-8'),
+            status=self.status_names[self.status_codes[index]],
+            perplexity=None if math.isnan(perplexity) else perplexity,
+        )
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __repr__(self):
+        return '<{} size={}>'.format(self.__class__.__name__, len(self))
+
+
+def to_epoch(time):
+    """
+    Converts a commit time (a datetime, or as stored by SQLite) to seconds
+    since the epoch.
+
+    >>> to_epoch('1970-01-02 00:00:00')
+    86400
+    """
+    if time is None:
+        return NO_TIME
+    if isinstance(time, str):
+        time = datetime.fromisoformat(time)
+    return calendar.timegm(time.timetuple())
+
+
+def from_epoch(seconds):
+    """
+    Converts seconds since the epoch to a time, as stored by SQLite.
+    """
+    if seconds == NO_TIME:
+        return None
+    return str(EPOCH + timedelta(seconds=seconds))
+
+
+# Columns written by save_columns(): (name, NumPy dtype). Perplexity and
+# cross-entropy are NaN when unknown.
+COLUMNS = (
+    ('repo_id', 'uint32'),
+    ('status_code', 'uint8'),
+    ('time', 'int64'),
+    ('perplexity', 'float64'),
+    ('cross_entropy', 'float64'),
+)
+DICTIONARY = 'dictionary.json'
+
+
+def save_columns(directory, commits):
+    """
+    Writes the commits' repository IDs, status codes, times, perplexities,
+    and cross-entropies (no SHAs or messages) as one .npy file per column,
+    and the names behind the IDs and codes as dictionary.json. Returns the
+    number of commits written.
+
+    >>> import tempfile
+    >>> with tempfile.TemporaryDirectory() as directory:
+    ...     save_columns(directory, [
+    ...         Commit('a/b', '0' * 40, '2016-01-31 12:00:00', None,
+    ...                'passed', 8.0),
+    ...         Commit('c/d', '1' * 40, None, None, None, None),
+    ...     ])
+    ...     columns = load_columns(directory)
+    ...     [columns.repo_names[i] for i in columns.repo_id]
+    ...     [columns.status_names[i] for i in columns.status_code]
+    ...     columns.cross_entropy.tolist()
+    2
+    ['a/b', 'c/d']
+    ['passed', None]
+    [3.0, nan]
+    """
+    import json
+    import os
+
+    import numpy
+
+    # Fill compact arrays first (the number of commits isn't known until
+    # the end), then write them without copying.
+    repos = Interner()
+    statuses = Interner([None], limit=256)
+    repo_ids = array('I')
+    status_codes = array('B')
+    times = array('q')
+    perplexities = array('d')
+    for commit in commits:
+        repo_ids.append(repos.code(commit.repo))
+        status_codes.append(statuses.code(commit.status))
+        times.append(to_epoch(commit.time))
+        perplexities.append(float('nan') if commit.perplexity is None
+                            else commit.perplexity)
+
+    os.makedirs(directory, exist_ok=True)
+    arrays = {
+        'repo_id': repo_ids,
+        'status_code': status_codes,
+        'time': times,
+        'perplexity': perplexities,
+        'cross_entropy': numpy.log2(numpy.frombuffer(perplexities,
+                                                     dtype='float64')),
+    }
+    for name, dtype in COLUMNS:
+        numpy.save(os.path.join(directory, name + '.npy'),
+                   numpy.frombuffer(arrays[name], dtype=dtype))
+
+    with open(os.path.join(directory, DICTIONARY), 'w',
+              encoding='UTF-8') as dictionary:
+        json.dump({'rows': len(repo_ids), 'repo': repos.names,
+                   'status': statuses.names}, dictionary)
+    return len(repo_ids)
+
+
+class Columns(object):
+    """
+    Columns written by save_columns(), as NumPy arrays (memory-mapped by
+    default), and the names of repository IDs and status codes.
+    """
+
+    def __init__(self, directory, mmap_mode='r'):
+        import json
+        import os
+
+        import numpy
+
+        with open(os.path.join(directory, DICTIONARY),
+                  encoding='UTF-8') as dictionary:
+            names = json.load(dictionary)
+        self.repo_names = names['repo']
+        self.status_names = names['status']
+        for name, _dtype in COLUMNS:
+            setattr(self, name, numpy.load(os.path.join(directory,
+                                                        name + '.npy'),
+                                           mmap_mode=mmap_mode))
+
+    def status_code_of(self, status):
+        return self.status_names.index(status)
+
+    def __len__(self):
+        return len(self.repo_id)
+
+
+def load_columns(directory, mmap_mode='r'):
+    """
+    Loads the columns written by save_columns(). By default, they are
+    memory-mapped (read-only), so loading takes no time, and processes
+    share the pages.
+    """
+    return Columns(directory, mmap_mode=mmap_mode)
@@ -18,68 +18,149 @@
 
 # I could have used nltk.model.ngrams, but it only works in Python 2 :C
 
+import itertools
 import pickle
+import tempfile
+from contextlib import closing
 
 from tqdm import tqdm
 
 import persist
-from commit import Commit
+from commit import FLAG_CANCELLED, TokenizedCommit
+from parallel import parallel_map
+from tokenize_commit import TOKENIZER_VERSION, tokenize
 from mit_language_model import MITLanguageModel, ModelError
 
 
-def load_commits_by_repo():
-    # SDafdjksanfdskanfjdskanf
-    repos = {}
-    cursor = persist.conn.execute(r'''
+def load_commits_by_repo(corpus):
+    """
+    Writes the tokens of every commit to evaluate to the corpus (a binary
+    file), one "sha tokens..." line per commit, grouped by repository.
+    Returns the (start, end) byte offsets of each repository's lines.
+
+    Every repository is evaluated against all of the others, so each commit
+    is tokenized (or loaded) only once; but only one repository's commits
+    are ever held in memory.
+    """
+    cursor = persist.connection().execute(r'''
         SELECT
-            c.repo, c.sha, c.time, c.message, NULL as status, NULL as perplexity
+            c.repo, c.sha, c.message, t.tokens_as_string, {current}
         FROM
             commits_raw as c
             JOIN status_check USING (repo, sha)
             JOIN project_lang USING (repo)
+            LEFT JOIN commit_flags AS f USING (repo, sha)
+            LEFT JOIN tokens AS t
+                ON t.repo = c.repo AND
+                   t.sha = c.sha AND
+                   t.tokenizer_version = :version
         WHERE
-            lang = 'en'
-    ''')
+            lang = 'en' AND
+            (({current}) IS NOT 1 OR {valid})
+        ORDER BY c.repo
+    '''.format(current=persist.current_flags_clause('f'),
+               # Commits of cancelled builds are still worth training on.
+               valid=persist.valid_only_clause('f', ignored=FLAG_CANCELLED)),
+        {'version': TOKENIZER_VERSION})
 
-    for row in tqdm(cursor, desc="Loading commits"):
-        commit = Commit(repo=row[0], sha=row[1], time=row[2], message=row[3],
-                        status=None, perplexity=None)
-        if commit.is_valid:
-            repos.setdefault(commit.repo, []).append(commit)
+    repos = {}
+    # Tokenize (and check) what wasn't saved on all cores. Close the pool
+    # as soon as we're done, even if something goes wrong.
+    with closing(parallel_map(_tokenize_row, tqdm(
+            cursor, desc="Loading commits"))) as rows:
+        for row in rows:
+            if row is None:
+                continue
+            repo, sha, tokens_as_string = row
+            start, _ = repos.setdefault(repo, (corpus.tell(), None))
+            corpus.write('{} {}\n'.format(sha, tokens_as_string)
+                         .encode('UTF-8'))
+            repos[repo] = start, corpus.tell()
+    corpus.flush()
 
     return repos
 
 
-def evaluate_repo(name, repositories):
-    # Get all commits NOT from this repository
-    other_commits = (c for repo_name, commits in repositories.items()
-                     for c in commits
-                     if repo_name != name)
+def _tokenize_row(row):
+    """
+    Returns the (repo, sha, tokens_as_string) of a row, tokenizing it if its
+    tokens weren't saved; or None, if it's not valid.
+    """
+    repo, sha, message, tokens_as_string, current_flags = row
+    if tokens_as_string is None:
+        tokens_as_string = ' '.join(tokenize(message))
+    # Only commits without current flags still need to be checked.
+    if not current_flags:
+        commit = TokenizedCommit(repo=repo, sha=sha, time=None,
+                                 message=message, status=None,
+                                 perplexity=None,
+                                 tokens_as_string=tokens_as_string)
+        if not commit.is_valid:
+            return None
+    return repo, sha, tokens_as_string
+
+
+def read_corpus(filename, repo=None, start=0, end=None):
+    """
+    Yields the commits in the corpus between the byte offsets, as
+    TokenizedCommits (with only a SHA and tokens) of the given repository.
+    """
+    with open(filename, 'rb') as corpus:
+        corpus.seek(start)
+        position = start
+        for line in corpus:
+            if end is not None and position >= end:
+                return
+            position += len(line)
+            sha, _, tokens_as_string = line.decode('UTF-8')[:-1].partition(' ')
+            yield TokenizedCommit(repo=repo, sha=sha, time=None, message=None,
+                                  status=None, perplexity=None,
+                                  tokens_as_string=tokens_as_string)
+
+
+# Total number of messages not evaluated, because an identical message in
+# the same repository was evaluated already.
+evaluations_saved = 0
+
+
+def evaluate_repo(name, corpus, repositories):
+    # Get all commits NOT from this repository: all before, and all after.
+    start, end = repositories[name]
+    other_commits = itertools.chain(read_corpus(corpus, end=start),
+                                    read_corpus(corpus, start=end))
     model = None
 
     def perplexities():
         assert model is not None
-        for commit in repositories[name]:
+        for commit in read_corpus(corpus, name, start, end):
             perplexity = model.evaluate_perlexity(commit)
             yield commit.repo, commit.sha, perplexity
 
+    global evaluations_saved
     with MITLanguageModel(other_commits) as model:
-        return tuple(perplexities())
+        results = tuple(perplexities())
+        evaluations_saved += model.evaluations_saved
+        return results
 
 
 def main():
-    repositories = load_commits_by_repo()
-    repo_names = tuple(repositories.keys())
-
-    with open('errors.csv', 'w') as errors:
-        for name in tqdm(repo_names, desc="Repositories"):
+    persist.init_db()
+    with tempfile.NamedTemporaryFile(suffix='.corpus') as corpus, \
+            open('errors.csv', 'w') as errors:
+        repositories = load_commits_by_repo(corpus)
+        for name in tqdm(tuple(repositories), desc="Repositories"):
             try:
-                lines = evaluate_repo(name, repositories)
+                lines = evaluate_repo(name, corpus.name, repositories)
                 for repo, sha, perp in tqdm(lines, desc="Commits"):
                     persist.insert_perplexity(repo, sha, perp)
             except ModelError:
                 print(name, file=errors)
                 errors.flush()
 
+    persist.refresh_materialized()
+
+    print("Evaluations saved by identical messages:", evaluations_saved)
+
+
 if __name__ == '__main__':
     main()
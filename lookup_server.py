@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+# -*- encoding: UTF-8 -*-
+
+# Copyright 2016 Eddie Antonio Santos <easantos@ualberta.ca>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A resident server that looks up commits, so that every look-up doesn't pay
+for starting Python, importing persist, and opening the database. It keeps
+its connection and the token and language caches warm.
+
+Usage:
+    lookup_server.py serve [address]
+    lookup_server.py sha <sha>
+    lookup_server.py repo <owner/name> [--valid-only]
+    lookup_server.py tokenize <message>
+
+The address is a Unix socket path, or [host]:port on localhost; it
+defaults to $LOOKUP_SERVER, or lookup.sock next to this file. Requests and
+replies are JSON, one per line:
+
+    {"op": "sha", "sha": "..."}
+    {"op": "repo", "repo": "owner/name", "valid_only": false}
+    {"op": "tokenize", "message": "..."}
+
+Replies are either {"result": ...} or {"error": "KeyError", "message": ...}.
+
+>>> import tempfile
+>>> with tempfile.TemporaryDirectory() as directory:
+...     with server_in_subprocess(os.path.join(directory, 's')) as client:
+...         tokens = client.tokenize('Fixed #22')
+...         try:
+...             client.sha('0' * 40)
+...         except KeyError:
+...             missing = True
+>>> tokens, missing
+(['fixed', 'ISSUE-NUMBER'], True)
+"""
+
+import json
+import os
+import socket
+import sys
+from contextlib import contextmanager
+
+
+ADDRESS = os.getenv('LOOKUP_SERVER',
+                    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'lookup.sock'))
+
+# Replies with these errors are raised as the same exception by the client.
+ERRORS = {'KeyError': KeyError, 'ValueError': ValueError}
+
+
+def parse_address(address):
+    """
+    Returns (host, port) for TCP addresses, or the path of a Unix socket.
+
+    >>> parse_address(':8765')
+    ('127.0.0.1', 8765)
+    >>> parse_address('localhost:8765')
+    ('localhost', 8765)
+    >>> parse_address('/tmp/lookup.sock')
+    '/tmp/lookup.sock'
+    """
+    host, colon, port = address.rpartition(':')
+    if colon and port.isdigit():
+        return host or '127.0.0.1', int(port)
+    return address
+
+
+class Client(object):
+    """
+    Sends requests to a running server, over one connection. Importing this
+    is cheap: it needs neither persist nor the database.
+    """
+
+    def __init__(self, address=ADDRESS):
+        address = parse_address(address)
+        if isinstance(address, tuple):
+            self._socket = socket.create_connection(address)
+        else:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(address)
+        self._file = self._socket.makefile('rwb')
+
+    def request(self, op, **arguments):
+        arguments['op'] = op
+        self._file.write(json.dumps(arguments).encode('UTF-8') + b'\n')
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError('server closed the connection')
+        reply = json.loads(line.decode('UTF-8'))
+        if 'error' in reply:
+            raise ERRORS.get(reply['error'], RuntimeError)(reply['message'])
+        return reply['result']
+
+    def sha(self, sha):
+        return self.request('sha', sha=sha)
+
+    def repo(self, repo, valid_only=False):
+        return self.request('repo', repo=repo, valid_only=valid_only)
+
+    def tokenize(self, message):
+        return self.request('tokenize', message=message)
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def look_up_sha(sha):
+    import persist
+    commit = persist.fetch_commit_by_sha(sha)
+    lang, confidence = commit.most_likely_language
+    return dict(commit._asdict(), tokens_as_string=commit.tokens_as_string,
+                lang=lang, confidence=confidence)
+
+
+def look_up_repo(repo, valid_only=False):
+    import persist
+    return [commit._asdict() for commit in
+            persist.fetch_commits_by_repo(repo, valid_only=valid_only)]
+
+
+def tokenize(message):
+    from tokenize_commit import tokenize
+    return tokenize(message)
+
+
+def warm_up():
+    """
+    Does the slow, one-time work (opening the database, importing langid)
+    before the first request, rather than during it.
+    """
+    import persist
+    from commit import classify_language
+    try:
+        persist.fetch_commit_by_sha('0' * 40)
+    except KeyError:
+        pass
+    classify_language('warm up')
+
+
+OPERATIONS = {
+    'sha': look_up_sha,
+    'repo': look_up_repo,
+    'tokenize': tokenize,
+}
+
+
+def answer(request):
+    """
+    Returns the reply to one request, as a dict.
+
+    >>> answer({'op': 'tokenize', 'message': 'Merge pull request #1'})
+    {'result': ['merge', 'pull', 'request', 'ISSUE-NUMBER']}
+    >>> answer({'op': 'delete'})
+    {'error': 'ValueError', 'message': "unknown op: 'delete'"}
+    """
+    arguments = dict(request)
+    op = arguments.pop('op', None)
+    try:
+        if op not in OPERATIONS:
+            raise ValueError('unknown op: {!r}'.format(op))
+        try:
+            return {'result': OPERATIONS[op](**arguments)}
+        except TypeError as error:
+            raise ValueError(str(error))
+    except Exception as error:
+        return {'error': type(error).__name__, 'message': str(error)}
+
+
+async def serve(address=ADDRESS):
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    import persist
+
+    persist.init_db()
+    loop = asyncio.get_running_loop()
+    # commit's caches are not thread-safe, so one thread (with a read-only
+    # connection) answers every request; the event loop only handles the
+    # sockets.
+    executor = ThreadPoolExecutor(max_workers=1,
+                                  thread_name_prefix='lookup',
+                                  initializer=persist.set_readonly)
+    await loop.run_in_executor(executor, warm_up)
+
+    async def handle(reader, writer):
+        try:
+            async for line in reader:
+                try:
+                    request = json.loads(line.decode('UTF-8'))
+                except ValueError as error:
+                    reply = {'error': 'ValueError', 'message': str(error)}
+                else:
+                    reply = await loop.run_in_executor(executor, answer,
+                                                       request)
+                writer.write(json.dumps(reply, default=str).encode('UTF-8') +
+                             b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+    address = parse_address(address)
+    if isinstance(address, tuple):
+        server = await asyncio.start_server(handle, *address)
+    else:
+        remove_stale_socket(address)
+        server = await asyncio.start_unix_server(handle, address)
+
+    print('Listening on', address, flush=True)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        executor.shutdown()
+        if not isinstance(address, tuple):
+            os.unlink(address)
+
+
+def remove_stale_socket(path):
+    """
+    Removes a socket left behind by a server that is no longer running.
+    """
+    if not os.path.exists(path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        os.unlink(path)
+    else:
+        raise OSError('a server is already listening on ' + path)
+    finally:
+        probe.close()
+
+
+@contextmanager
+def server_in_subprocess(address):
+    """
+    Starts a server in a new process, on a new, empty database; yields a
+    client connected to it.
+    """
+    import subprocess
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as directory:
+        environment = dict(os.environ, COMMIT_DATABASE=os.path.join(
+            directory, 'commits.sqlite'))
+        # Its errors go to our stderr.
+        server = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), 'serve', address],
+            stdout=subprocess.PIPE, env=environment)
+        try:
+            # It says when it's listening.
+            if not server.stdout.readline():
+                raise RuntimeError('server exited with status {}'.format(
+                    server.wait()))
+            with Client(address) as client:
+                yield client
+        finally:
+            server.terminate()
+            server.wait()
+            server.stdout.close()
+
+
+def main(mode=None, *arguments):
+    if mode == 'serve':
+        import asyncio
+        import signal
+        # Clean up (e.g., remove the socket) when terminated, too.
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            asyncio.run(serve(*arguments))
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    options = [a for a in arguments if a.startswith('--')]
+    arguments = [a for a in arguments if not a.startswith('--')]
+    if mode not in OPERATIONS or len(arguments) != 1:
+        print(__doc__.split('\n\n')[1], file=sys.stderr)
+        return -1
+
+    with Client() as client:
+        if mode == 'sha':
+            result = client.sha(arguments[0])
+        elif mode == 'repo':
+            result = client.repo(arguments[0],
+                                 valid_only='--valid-only' in options)
+        else:
+            result = client.tokenize(arguments[0])
+    print(json.dumps(result, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv[1:]))
@@ -13,7 +13,7 @@ from blessings import Terminal
 from tqdm import tqdm
 
 import persist
-from commit import Commit
+from commit import Commit, classify_languages, scoped_message_cache
 
 
 def singleton(cls):
@@ -91,17 +91,18 @@ class Prompt(object):
 def english_score_average(repository):
     commits = persist.fetch_commits_by_repo(repository)
 
-    valid_commits = [commit for commit in commits if commit.is_valid]
-    if not valid_commits:
-        return None, None, None
+    # Tokens are only needed while scoring this repository.
+    with scoped_message_cache():
+        valid_commits = [commit for commit in commits if commit.is_valid]
+        if not valid_commits:
+            return None, None, None
 
-    n = 0
-    score = 0.0
-    for commit in valid_commits:
-        n += 1
-        lang, confidence = commit.most_likely_language
-        if lang == 'en':
-            score += confidence
+        n = 0
+        score = 0.0
+        for lang, confidence in classify_languages(valid_commits):
+            n += 1
+            if lang == 'en':
+                score += confidence
 
     return repository, valid_commits, score / n
 
@@ -129,6 +130,7 @@ def repo_commits_with_rank():
 
 
 if __name__ == '__main__':
+    persist.init_db()
     repo_commits = repo_commits_with_rank()
     repo_commits.sort(key=lambda t: t[2])
 
@@ -36,11 +36,17 @@ class MITLanguageModel(object):
     def __init__(self, commits=None, order=3):
         self.name = None
         self.order = order
+        # Perplexities of single messages, by (tokens_as_string, order).
+        self._perplexities = {}
+        # How many times a message was not evaluated, because an identical
+        # message was evaluated before.
+        self.evaluations_saved = 0
         if commits is not None:
             self.train(commits)
 
     def train(self, commits):
         assert self.name is None
+        self._perplexities.clear()
 
         self.name = tempfile.mktemp()
         with tempfile.NamedTemporaryFile('wb') as text_file:
@@ -54,9 +60,29 @@ class MITLanguageModel(object):
         return self
 
     def evaluate_perlexity(self, commits, order=None):
+        """
+        Evaluates the perplexity of a single commit, or of many commits.
+        Each distinct message of a single commit is only evaluated once.
+        """
         if order is None:
             order = self.order
 
+        try:
+            key = (commits.tokens_as_string, order)
+        except AttributeError:
+            # Many commits.
+            return self._evaluate_perplexity(commits, order)
+
+        try:
+            perplexity = self._perplexities[key]
+        except KeyError:
+            perplexity = self._evaluate_perplexity(commits, order)
+            self._perplexities[key] = perplexity
+        else:
+            self.evaluations_saved += 1
+        return perplexity
+
+    def _evaluate_perplexity(self, commits, order):
         with tempfile.NamedTemporaryFile('wb') as text_file:
             print_commits(commits, text_file)
             try:
@@ -71,6 +97,7 @@ class MITLanguageModel(object):
         if self.name:
             os.remove(self.name)
             self.name = None
+        self._perplexities.clear()
 
 
 def print_commits(maybe_commits, file_obj):
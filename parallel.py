@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- encoding: UTF-8 -*-
+
+# Copyright 2016 Eddie Antonio Santos <easantos@ualberta.ca>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+import os
+from collections import deque
+from contextlib import contextmanager
+from multiprocessing import Pool
+
+
+# How many items to send to a worker at a time.
+DEFAULT_CHUNKSIZE = 1024
+
+# (workers, pool) that parallel_map() uses, instead of starting a new pool;
+# see shared_pool().
+_SHARED_POOL = None
+
+
+@contextmanager
+def shared_pool(workers=None):
+    """
+    Makes every parallel_map() with this many workers use the same pool,
+    until done, rather than start (and stop) a pool each time. Use it around
+    loops that map each batch in parallel:
+
+        with shared_pool(workers):
+            for batch in batches:
+                ...
+    """
+    global _SHARED_POOL
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers == 1 or _SHARED_POOL is not None:
+        # Nothing to share, or already shared.
+        yield
+        return
+
+    with Pool(workers) as pool:
+        _SHARED_POOL = (workers, pool)
+        try:
+            yield
+        finally:
+            _SHARED_POOL = None
+
+
+def parallel_map(function, items, workers=None, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Yields function(item) for each item, computed in chunks on a pool of
+    worker processes, in order. Only a few chunks per worker are in flight
+    at any time, so items may be a (very long) generator. The function must
+    be picklable (i.e., defined at the top level of a module).
+
+    When workers is None, uses one worker per CPU. When workers is 1,
+    applies the function in this process.
+
+    >>> list(parallel_map(abs, [-1, 2, -3], workers=1))
+    [1, 2, 3]
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    assert workers >= 1
+    assert chunksize >= 1
+
+    if workers == 1:
+        for item in items:
+            yield function(item)
+        return
+
+    if _SHARED_POOL is not None and _SHARED_POOL[0] == workers:
+        yield from _map_in_pool(_SHARED_POOL[1], function, items, workers,
+                                chunksize)
+        return
+
+    with Pool(workers) as pool:
+        yield from _map_in_pool(pool, function, items, workers, chunksize)
+
+
+def _map_in_pool(pool, function, items, workers, chunksize):
+    # Keep every worker busy, with one chunk queued up behind it.
+    max_in_flight = 2 * workers
+    items = iter(items)
+    chunks = iter(lambda: list(itertools.islice(items, chunksize)), [])
+
+    in_flight = deque()
+    for chunk in chunks:
+        in_flight.append(pool.apply_async(_map_chunk, (function, chunk)))
+        if len(in_flight) >= max_in_flight:
+            yield from in_flight.popleft().get()
+    while in_flight:
+        yield from in_flight.popleft().get()
+
+
+def _map_chunk(function, chunk):
+    return [function(item) for item in chunk]
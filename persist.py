@@ -16,15 +16,25 @@
 # limitations under the License.
 
 import itertools
+import json
 import os
 import re
 import sqlite3
+import sys
+import threading
+import zlib
+from collections import deque, namedtuple
+from contextlib import contextmanager, nullcontext
 from datetime import datetime
 from itertools import repeat
+from time import perf_counter
+from urllib.parse import quote
 
-from tqdm import tqdm
-
-from commit import Commit
+import commit
+from parallel import shared_pool
+from commit import (Commit, LazyCommit, FLAG_CANCELLED, FLAGS_VERSION,
+                    classify_languages, prime_message_cache, valid_flags)
+from tokenize_commit import TOKENIZER_VERSION, iter_tokenize_many
 
 
 SCHEMA = """\
@@ -101,6 +111,78 @@ perplexity_autogen (
 ) WITHOUT ROWID;
 
 
+-- Tokenized commit messages, for a particular version of the tokenizer.
+CREATE TABLE IF NOT EXISTS
+tokens (
+    repo    TEXT NOT NULL,
+    sha     TEXT NOT NULL,
+
+    -- Hash of the tokenizer's rules (tokenize_commit.TOKENIZER_VERSION).
+    tokenizer_version   TEXT NOT NULL,
+    tokens_as_string    TEXT NOT NULL,
+
+    PRIMARY KEY (repo, sha, tokenizer_version)
+) WITHOUT ROWID;
+
+
+-- Most likely natural language of each commit message, according to langid.
+CREATE TABLE IF NOT EXISTS
+commit_lang (
+    repo        TEXT NOT NULL,
+    sha         TEXT NOT NULL,
+    lang        TEXT NOT NULL,
+    confidence  REAL NOT NULL,
+
+    PRIMARY KEY (repo, sha)
+) WITHOUT ROWID;
+
+
+-- Precomputed Commit.flags (see commit.FLAG_*), so that valid commits can be
+-- found without tokenizing them.
+CREATE TABLE IF NOT EXISTS
+commit_flags (
+    repo    TEXT NOT NULL,
+    sha     TEXT NOT NULL,
+    flags   INTEGER NOT NULL,
+
+    -- Flags depend on the tokenizer and templates (commit.FLAGS_VERSION).
+    flags_version   TEXT NOT NULL,
+
+    PRIMARY KEY (repo, sha)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS
+commit_flags_flags ON commit_flags (flags);
+
+-- Statuses usually arrive after commits: keep FLAG_CANCELLED (8) in step
+-- with them. Replacing a status deletes the old one first (this needs
+-- recursive_triggers).
+CREATE TRIGGER IF NOT EXISTS
+commit_flags_cancelled AFTER INSERT ON status_check
+WHEN NEW.status = 'canceled'
+BEGIN
+    UPDATE commit_flags SET flags = flags | 8
+    WHERE repo = NEW.repo AND sha = NEW.sha;
+END;
+
+CREATE TRIGGER IF NOT EXISTS
+commit_flags_cancelled_delete AFTER DELETE ON status_check
+WHEN OLD.status = 'canceled'
+BEGIN
+    UPDATE commit_flags SET flags = flags & ~8
+    WHERE repo = OLD.repo AND sha = OLD.sha;
+END;
+
+CREATE TRIGGER IF NOT EXISTS
+commit_flags_cancelled_update AFTER UPDATE OF status ON status_check
+BEGIN
+    UPDATE commit_flags
+    SET flags = (flags & ~8) |
+                (CASE WHEN NEW.status = 'canceled' THEN 8 ELSE 0 END)
+    WHERE repo = NEW.repo AND sha = NEW.sha;
+END;
+
+
 CREATE VIEW IF NOT EXISTS commits
 AS SELECT
     c.repo AS repo,
@@ -153,32 +235,515 @@ FROM
 -- forks, there are probably duplicates.
 CREATE INDEX IF NOT EXISTS
 commit_sha ON commits_raw (sha);
+
+-- Find the repositories in a language, without scanning them all.
+CREATE INDEX IF NOT EXISTS
+project_lang_lang ON project_lang (lang);
+
+
+-- The commits view, materialized. See refresh_materialized().
+CREATE TABLE IF NOT EXISTS
+commits_mat (
+    repo        TEXT NOT NULL,
+    sha         TEXT NOT NULL,
+    time        DATE NOT NULL,
+    message     TEXT NOT NULL,
+    status      TEXT NOT NULL,
+    perplexity  REAL NOT NULL,
+
+    PRIMARY KEY (repo, sha)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS
+commits_mat_sha ON commits_mat (sha);
+
+-- Commits that may have changed since commits_mat was last refreshed.
+CREATE TABLE IF NOT EXISTS
+commits_mat_pending (
+    repo    TEXT NOT NULL,
+    sha     TEXT NOT NULL,
+
+    PRIMARY KEY (repo, sha)
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS
+commits_mat_pending_commit AFTER INSERT ON commits_raw
+BEGIN
+    INSERT OR IGNORE INTO commits_mat_pending VALUES (NEW.repo, NEW.sha);
+END;
+
+CREATE TRIGGER IF NOT EXISTS
+commits_mat_pending_status AFTER INSERT ON status_check
+BEGIN
+    INSERT OR IGNORE INTO commits_mat_pending VALUES (NEW.repo, NEW.sha);
+END;
+
+CREATE TRIGGER IF NOT EXISTS
+commits_mat_pending_perplexity AFTER INSERT ON perplexity
+BEGIN
+    INSERT OR IGNORE INTO commits_mat_pending VALUES (NEW.repo, NEW.sha);
+END;
+
+-- Deleted (or replaced) rows must leave commits_mat, too.
+CREATE TRIGGER IF NOT EXISTS
+commits_mat_pending_delete_commit AFTER DELETE ON commits_raw
+BEGIN
+    INSERT OR IGNORE INTO commits_mat_pending VALUES (OLD.repo, OLD.sha);
+END;
+
+CREATE TRIGGER IF NOT EXISTS
+commits_mat_pending_delete_status AFTER DELETE ON status_check
+BEGIN
+    INSERT OR IGNORE INTO commits_mat_pending VALUES (OLD.repo, OLD.sha);
+END;
+
+CREATE TRIGGER IF NOT EXISTS
+commits_mat_pending_delete_perplexity AFTER DELETE ON perplexity
+BEGIN
+    INSERT OR IGNORE INTO commits_mat_pending VALUES (OLD.repo, OLD.sha);
+END;
+
+-- When each materialized table was last refreshed.
+CREATE TABLE IF NOT EXISTS
+materialized (
+    name        TEXT PRIMARY KEY,
+    refreshed   DATE NOT NULL
+) WITHOUT ROWID;
+
+
+-- Per-repository totals, kept up to date by the triggers below.
+-- See rebuild_summaries().
+CREATE TABLE IF NOT EXISTS
+repo_summary (
+    repo        TEXT PRIMARY KEY,
+    -- Raw commits, and how many of them have a status.
+    commits     INTEGER NOT NULL DEFAULT 0,
+    with_status INTEGER NOT NULL DEFAULT 0,
+    -- Fully-processed commits (what the repositories view counts): those in
+    -- commits_mat, so as of its last refresh.
+    processed   INTEGER NOT NULL DEFAULT 0,
+    -- Number, sum, and sum of squares of the perplexities.
+    perplexities        INTEGER NOT NULL DEFAULT 0,
+    perplexity_sum      REAL NOT NULL DEFAULT 0.0,
+    perplexity_sum_sq   REAL NOT NULL DEFAULT 0.0
+) WITHOUT ROWID;
+
+-- How many of each status every repository has.
+CREATE TABLE IF NOT EXISTS
+repo_status_counts (
+    repo    TEXT NOT NULL,
+    status  TEXT NOT NULL,
+    count   INTEGER NOT NULL,
+
+    PRIMARY KEY (repo, status)
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS
+repo_summary_insert_commit AFTER INSERT ON commits_raw
+BEGIN
+    INSERT INTO repo_summary (repo, commits, with_status)
+    VALUES (NEW.repo, 1, EXISTS (
+        SELECT 1 FROM status_check WHERE repo = NEW.repo AND sha = NEW.sha
+    ))
+    ON CONFLICT (repo) DO UPDATE
+    SET commits = commits + 1,
+        with_status = with_status + excluded.with_status;
+END;
+
+CREATE TRIGGER IF NOT EXISTS
+repo_summary_delete_commit AFTER DELETE ON commits_raw
+BEGIN
+    UPDATE repo_summary
+    SET commits = commits - 1,
+        with_status = with_status - EXISTS (
+            SELECT 1 FROM status_check WHERE repo = OLD.repo AND sha = OLD.sha
+        )
+    WHERE repo = OLD.repo;
+END;
+
+CREATE TRIGGER IF NOT EXISTS
+repo_summary_insert_status AFTER INSERT ON status_check
+BEGIN
+    INSERT INTO repo_status_counts (repo, status, count)
+    VALUES (NEW.repo, NEW.status, 1)
+    ON CONFLICT (repo, status) DO UPDATE SET count = count + 1;
+
+    UPDATE repo_summary SET with_status = with_status + 1
+    WHERE repo = NEW.repo AND EXISTS (
+        SELECT 1 FROM commits_raw WHERE repo = NEW.repo AND sha = NEW.sha
+    );
+END;
+
+CREATE TRIGGER IF NOT EXISTS
+repo_summary_delete_status AFTER DELETE ON status_check
+BEGIN
+    UPDATE repo_status_counts SET count = count - 1
+    WHERE repo = OLD.repo AND status = OLD.status;
+
+    UPDATE repo_summary SET with_status = with_status - 1
+    WHERE repo = OLD.repo AND EXISTS (
+        SELECT 1 FROM commits_raw WHERE repo = OLD.repo AND sha = OLD.sha
+    );
+END;
+
+CREATE TRIGGER IF NOT EXISTS
+repo_summary_insert_perplexity AFTER INSERT ON perplexity
+BEGIN
+    INSERT INTO repo_summary (
+        repo, perplexities, perplexity_sum, perplexity_sum_sq
+    )
+    VALUES (NEW.repo, 1, NEW.perplexity, NEW.perplexity * NEW.perplexity)
+    ON CONFLICT (repo) DO UPDATE
+    SET perplexities = perplexities + 1,
+        perplexity_sum = perplexity_sum + excluded.perplexity_sum,
+        perplexity_sum_sq = perplexity_sum_sq + excluded.perplexity_sum_sq;
+END;
+
+CREATE TRIGGER IF NOT EXISTS
+repo_summary_delete_perplexity AFTER DELETE ON perplexity
+BEGIN
+    UPDATE repo_summary
+    SET perplexities = perplexities - 1,
+        perplexity_sum = perplexity_sum - OLD.perplexity,
+        perplexity_sum_sq = perplexity_sum_sq -
+                            OLD.perplexity * OLD.perplexity
+    WHERE repo = OLD.repo;
+END;
+
+
+-- How far into each CSV file rows have been inserted; see insert_from_csv().
+CREATE TABLE IF NOT EXISTS
+csv_checkpoint (
+    filename    TEXT PRIMARY KEY,
+    mode        TEXT NOT NULL,
+    byte_offset INTEGER NOT NULL,
+    row_number  INTEGER NOT NULL,
+
+    -- Insertion date.
+    time    DATE NOT NULL
+            DEFAULT CURRENT_TIMESTAMP
+) WITHOUT ROWID;
 """
 
 FILENAME = os.getenv('COMMIT_DATABASE',
                      os.path.join(os.path.dirname(__file__),
                                   'commits.sqlite'))
 
-# Connect initially, and create the schema.
-conn = sqlite3.connect(FILENAME)
-conn.executescript(SCHEMA)
+# Connections can't be shared between threads or processes, so each thread
+# of each process opens its own, when it first needs one.
+_local = threading.local()
 
 
-def insert_commit(repo, sha, time, message):
+def _thread_state():
     """
-    Persist  a raw commit from Boa.
+    This thread's connections, forgetting any inherited from a parent
+    process.
     """
+    pid = os.getpid()
+    if getattr(_local, 'pid', None) != pid:
+        _local.pid = pid
+        _local.connections = {}
+        _local.readonly = False
+    return _local
+
+
+def set_readonly(readonly=True):
+    """
+    Makes connection() in this thread return a read-only connection by
+    default. Use this for workers that only read.
+    """
+    _thread_state().readonly = readonly
+
+
+def connection(readonly=None):
+    """
+    Returns this thread's connection to the database, opening it if needed.
+    Read-only connections (mode=ro) fail on writes, and don't need the
+    database to be writable.
+    """
+    state = _thread_state()
+    if readonly is None:
+        readonly = state.readonly
+
+    try:
+        return state.connections[readonly]
+    except KeyError:
+        pass
+
+    if readonly:
+        uri = 'file:{}?mode=ro'.format(quote(os.path.abspath(FILENAME)))
+        conn = sqlite3.connect(uri, uri=True)
+    else:
+        conn = sqlite3.connect(FILENAME)
+        # So that replacing a row fires the DELETE triggers.
+        conn.execute('PRAGMA recursive_triggers = ON')
+    state.connections[readonly] = conn
+    return conn
+
+
+# Stored as the database's user_version once the schema is created; it
+# changes whenever the schema does.
+SCHEMA_VERSION = zlib.crc32(SCHEMA.encode('UTF-8')) & 0x7fffffff
+
+# The schema and queries use row values (SQLite 3.15) and UPSERT (3.24); the
+# repository and SHA filters use json_each() from the JSON1 extension.
+MINIMUM_SQLITE_VERSION = (3, 24, 0)
+
+
+def init_db():
+    """
+    Creates the schema, unless the database already has this version of it.
+    """
+    if sqlite3.sqlite_version_info < MINIMUM_SQLITE_VERSION:
+        raise RuntimeError('SQLite {} is too old; {} is needed'.format(
+            sqlite3.sqlite_version,
+            '.'.join(map(str, MINIMUM_SQLITE_VERSION))))
+
+    conn = connection(readonly=False)
+    version, = conn.execute('PRAGMA user_version').fetchone()
+    if version == SCHEMA_VERSION:
+        return
+
+    existing = set(name for name, in conn.execute('''
+        SELECT name FROM sqlite_master WHERE name IN (
+            'repo_summary', 'commits_mat'
+        )
+    '''))
+    conn.executescript(SCHEMA)
+    flags_columns = set(row[1] for row in conn.execute(
+        'PRAGMA table_info(commit_flags)'))
+    if 'flags_version' not in flags_columns:
+        # Flags computed before they had a version are stale.
+        conn.execute('''
+            ALTER TABLE commit_flags
+            ADD COLUMN flags_version TEXT NOT NULL DEFAULT ''
+        ''')
+    summary_columns = set(row[1] for row in conn.execute(
+        'PRAGMA table_info(repo_summary)'))
+    if 'processed' not in summary_columns:
+        conn.execute('''
+            ALTER TABLE repo_summary
+            ADD COLUMN processed INTEGER NOT NULL DEFAULT 0
+        ''')
+        existing.discard('repo_summary')
+    # Fill in the tables that derive from data inserted before they (and
+    # their triggers) existed.
+    if 'commits_mat' not in existing:
+        refresh_materialized(full=True)
+    if 'repo_summary' not in existing:
+        rebuild_summaries()
+    conn.execute('PRAGMA user_version = {:d}'.format(SCHEMA_VERSION))
+
+
+def rebuild_summaries():
+    """
+    Recomputes repo_summary and repo_status_counts from scratch. The
+    triggers keep them up to date after that.
+    """
+    conn = connection(readonly=False)
+    with conn:
+        conn.execute('DELETE FROM repo_summary')
+        conn.execute('DELETE FROM repo_status_counts')
+        conn.execute('''
+            INSERT INTO repo_summary (repo, commits, with_status)
+            SELECT c.repo, COUNT(*), COUNT(s.sha)
+            FROM
+                commits_raw AS c
+                LEFT JOIN status_check AS s USING (repo, sha)
+            GROUP BY c.repo
+        ''')
+        conn.execute('''
+            INSERT INTO repo_summary (
+                repo, perplexities, perplexity_sum, perplexity_sum_sq
+            )
+            SELECT repo, COUNT(*), SUM(perplexity),
+                   SUM(perplexity * perplexity)
+            FROM perplexity
+            GROUP BY repo
+            ON CONFLICT (repo) DO UPDATE
+            SET perplexities = excluded.perplexities,
+                perplexity_sum = excluded.perplexity_sum,
+                perplexity_sum_sq = excluded.perplexity_sum_sq
+        ''')
+        count_processed(conn)
+        conn.execute('''
+            INSERT INTO repo_status_counts (repo, status, count)
+            SELECT repo, status, COUNT(*)
+            FROM status_check
+            GROUP BY repo, status
+        ''')
+
+
+# Modules that are slow to import, and that looking up a commit should not
+# need.
+DEFERRED_IMPORTS = ('langid', 'numpy', 'tqdm', 'commit_table')
+
+# Seconds that looking up a commit may take, on top of starting Python and
+# importing sqlite3. It's generous: it's usually under 0.1 seconds.
+STARTUP_BUDGET = 0.5
+
+
+def startup_profile(sha='0' * 40):
+    """
+    Looks up a commit in a new Python process, like `persist.py lookup-sha`
+    does, on a new, empty database. Returns how many seconds longer it took
+    than starting Python and importing sqlite3 (so that how fast this
+    computer is mostly cancels out), and which of the DEFERRED_IMPORTS were
+    imported anyway.
+
+    >>> seconds, imported = startup_profile()
+    >>> imported
+    []
+    >>> seconds < STARTUP_BUDGET
+    True
+    """
+    import subprocess
+    script = """
+try:
+    persist.fetch_commit_by_sha({sha!r})
+except KeyError:
+    pass
+print(' '.join(m for m in {deferred!r} if m in sys.modules))
+""".format(sha=sha, deferred=DEFERRED_IMPORTS)
+
+    start = perf_counter()
+    subprocess.check_call([sys.executable, '-c', 'import sqlite3'])
+    baseline = perf_counter() - start
+
+    start = perf_counter()
+    output = run_on_new_database(script)
+    seconds = perf_counter() - start
+    return seconds - baseline, output.split()
+
+
+def run_on_new_database(script):
+    """
+    Runs the script in a new Python process, after importing sys and
+    persist, on a new, empty database. Returns what it printed.
+    """
+    import subprocess
+    import tempfile
+    script = 'import sys\nimport persist\npersist.init_db()\n' + script
+
+    with tempfile.TemporaryDirectory() as directory:
+        environment = dict(os.environ, COMMIT_DATABASE=os.path.join(
+            directory, 'commits.sqlite'))
+        output = subprocess.check_output(
+            [sys.executable, '-c', script], env=environment,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+    return output.decode('UTF-8')
+
+
+def __getattr__(name):
+    # For compatibility: persist.conn is this thread's connection. (Module
+    # __getattr__ needs Python 3.7.)
+    if name == 'conn':
+        return connection()
+    raise AttributeError(name)
+
+
+# What to do when inserting a row that is already persisted, by table:
+# 'abort' (raise IntegrityError), 'ignore' (keep the old row), or 'replace'.
+ON_CONFLICT = {
+    'commits_raw': 'ignore',
+    'status_check': 'replace',
+    'perplexity': 'replace',
+}
+
+
+def insert_or(table, on_conflict=None):
+    """
+    The start of an INSERT statement, that resolves conflicts according to
+    on_conflict, or the table's policy in ON_CONFLICT.
+
+    >>> insert_or('commits_raw')
+    'INSERT OR IGNORE INTO commits_raw'
+    >>> insert_or('perplexity', 'abort')
+    'INSERT OR ABORT INTO perplexity'
+    """
+    if on_conflict is None:
+        on_conflict = ON_CONFLICT.get(table, 'abort')
+    if on_conflict not in ('abort', 'ignore', 'replace'):
+        raise ValueError('Invalid conflict resolution: %r' % (on_conflict,))
+    return 'INSERT OR {} INTO {}'.format(on_conflict.upper(), table)
+
+
+def check_commit(repo, sha, time, message):
     assert '/' in repo, 'Invalid repository name: %r' % (repo,)
     assert re.match(r'[a-f0-9]{40}', sha), 'Invalid SHA: %r' % (sha, )
     assert isinstance(time, datetime), 'Not a valid datetime: %r' % (time,)
     assert message is not None
 
+
+def insert_commit(repo, sha, time, message):
+    """
+    Persist  a raw commit from Boa.
+    """
+    check_commit(repo, sha, time, message)
+
+    commit = Commit(repo=repo, sha=sha, time=time, message=message,
+                    status=None, perplexity=None)
+
+    conn = connection()
     with conn:
-        conn.execute('''\
-            INSERT INTO commits_raw (
+        cursor = conn.execute('''\
+            {insert} (
                 repo, sha, time, message
             ) VALUES (?, ?, ?, ?)
-        ''', (repo, sha, time, message))
+        '''.format(insert=insert_or('commits_raw')),
+            (repo, sha, time, message))
+        # An ignored commit keeps its flags.
+        if cursor.rowcount:
+            insert_flags((commit,))
+
+
+def insert_flags(commits):
+    """
+    Persist the flags of the given commits. FLAG_CANCELLED is also set if a
+    cancelled status is already persisted.
+    """
+    conn = connection()
+    conn.executemany('''
+        INSERT OR REPLACE INTO commit_flags (repo, sha, flags, flags_version)
+        SELECT
+            :repo, :sha,
+            :flags | CASE WHEN EXISTS (
+                SELECT 1 FROM status_check
+                WHERE repo = :repo AND sha = :sha AND status = 'canceled'
+            ) THEN :cancelled ELSE 0 END,
+            :version
+    ''', ({'repo': c.repo, 'sha': c.sha, 'flags': c.flags,
+           'cancelled': FLAG_CANCELLED, 'version': FLAGS_VERSION}
+          for c in commits))
+
+
+def current_flags_clause(alias):
+    """
+    Condition on the commit_flags table (by its alias in the query) for
+    flags computed by this version of the tokenizer and templates.
+
+    >>> current_flags_clause('f') == "f.flags_version = '{}'".format(
+    ...     FLAGS_VERSION)
+    True
+    """
+    return "{}.flags_version = '{}'".format(alias, FLAGS_VERSION)
+
+
+def valid_only_clause(alias, autogen=False, ignored=0):
+    """
+    Condition on the commit_flags table (by its alias in the query) for
+    valid commits only, disregarding the ignored flags. Stale flags are not
+    trusted. It only uses constants, and the flags index.
+
+    >>> valid_only_clause('f')  # doctest: +ELLIPSIS
+    "f.flags IN (0, 16) AND f.flags_version = '...'"
+    >>> valid_only_clause('f', ignored=FLAG_CANCELLED)  # doctest: +ELLIPSIS
+    "f.flags IN (0, 8, 16, 24) AND f.flags_version = '...'"
+    """
+    return '{alias}.flags IN ({flags}) AND {current}'.format(
+        alias=alias,
+        flags=', '.join(map(str, valid_flags(autogen, ignored))),
+        current=current_flags_clause(alias))
 
 
 def fetch_commit(repo=None, sha=None):
@@ -190,10 +755,11 @@ def fetch_commit(repo=None, sha=None):
     if not repo:
         return fetch_commit_by_sha(sha)
 
+    conn = connection()
     cursor = conn.execute('''
         SELECT
             repo, sha, time, message, status, perplexity
-        FROM commits
+        FROM commits_mat
         WHERE
             repo = ? AND
             sha = ?
@@ -206,10 +772,11 @@ def fetch_commit(repo=None, sha=None):
 
 
 def fetch_commit_by_sha(sha):
+    conn = connection()
     cursor = conn.execute('''
         SELECT
             repo, sha, time, message, status, perplexity
-        FROM commits
+        FROM commits_mat
         WHERE
             sha = ?
     ''', (sha,))
@@ -220,17 +787,71 @@ def fetch_commit_by_sha(sha):
         raise KeyError(sha)
 
 
+def fetch_commits_by_shas(shas, chunk=500, forks='first'):
+    """
+    Fetches many commits by their SHAs, a chunk of SHAs per query. Returns
+    a dictionary of SHA to commit, and a list of the SHAs that were not
+    found.
+
+    Forks share SHAs, so forks decides which commit a SHA maps to:
+    'first' (the repository whose name sorts first), 'all' (a list of every
+    commit, sorted by repository), or a sequence of preferred repositories
+    (the first one that has the commit, otherwise the first commit).
+
+    >>> print(run_on_new_database(
+    ...     "print(persist.fetch_commits_by_shas(['0' * 40]))"), end='')
+    ({}, ['0000000000000000000000000000000000000000'])
+    """
+    if isinstance(forks, str):
+        if forks not in ('first', 'all'):
+            raise ValueError('Invalid fork policy: %r' % (forks,))
+        preference = {}
+    else:
+        preference = {repo: rank for rank, repo in enumerate(forks)}
+    # One parameter per SHA must fit in SQLite's variable limit.
+    assert 0 < chunk <= 999
+
+    conn = connection()
+    # Remove duplicates, but keep the order of the misses.
+    shas = list(dict.fromkeys(shas))
+    found = {}
+
+    for start in range(0, len(shas), chunk):
+        keys = shas[start:start + chunk]
+        cursor = conn.execute('''
+            SELECT
+                c.repo, c.sha, c.time, c.message, c.status, c.perplexity
+            FROM
+                (VALUES {}) AS k
+                CROSS JOIN commits_mat AS c ON c.sha = k.column1
+            ORDER BY c.sha, c.repo
+        '''.format(', '.join(repeat('(?)', len(keys)))), keys)
+        for row in cursor:
+            found.setdefault(row[1], []).append(Commit(*row))
+
+    if forks == 'all':
+        commits = found
+    else:
+        # Rows are sorted by repository; min() keeps the first of any ties.
+        commits = {sha: min(candidates,
+                            key=lambda c: preference.get(c.repo,
+                                                         len(preference)))
+                   for sha, candidates in found.items()}
+    return commits, [sha for sha in shas if sha not in found]
+
+
 def insert_status(repo, sha, status):
     """
     Persist a build status.
     """
+    conn = connection()
 
     with conn:
         conn.execute('''\
-            INSERT INTO status_check (
+            {insert} (
                 repo, sha, status
             ) VALUES (?, ?, ?)
-        ''', (repo, sha, status))
+        '''.format(insert=insert_or('status_check')), (repo, sha, status))
 
 
 def insert_perplexity(repo, sha, perplexity):
@@ -238,13 +859,83 @@ def insert_perplexity(repo, sha, perplexity):
     Persist perplexity.  You must manually calculate cross-entropy when
     retrieving these values.
     """
+    conn = connection()
 
     with conn:
         conn.execute('''\
-            INSERT INTO perplexity (
+            {insert} (
                 repo, sha, perplexity
             ) VALUES (?, ?, ?)
-        ''', (repo, sha, perplexity))
+        '''.format(insert=insert_or('perplexity')), (repo, sha, perplexity))
+
+
+def count_processed(conn, pending_only=False):
+    """
+    Recounts repo_summary.processed from commits_mat, for every repository,
+    or only for those with commits in commits_mat_pending.
+    """
+    conn.execute('''
+        UPDATE repo_summary
+        SET processed = (
+            SELECT COUNT(*) FROM commits_mat AS m
+            WHERE m.repo = repo_summary.repo
+        )
+    ''' + ('''
+        WHERE repo IN (SELECT repo FROM commits_mat_pending)
+    ''' if pending_only else ''))
+
+
+def refresh_materialized(full=False):
+    """
+    Brings commits_mat up to date with the commits view, only looking at
+    the commits that were inserted since the last refresh (or at every
+    commit, if full is True or it was never refreshed). The processed
+    counts in repo_summary follow.
+    """
+    conn = connection(readonly=False)
+    never_refreshed = conn.execute('''
+        SELECT NOT EXISTS (
+            SELECT 1 FROM materialized WHERE name = 'commits_mat'
+        )
+    ''').fetchone()[0]
+
+    with conn:
+        if full or never_refreshed:
+            conn.execute('DELETE FROM commits_mat')
+            conn.execute('''
+                INSERT INTO commits_mat (
+                    repo, sha, time, message, status, perplexity
+                )
+                SELECT repo, sha, time, message, status, perplexity
+                FROM commits
+            ''')
+        else:
+            conn.execute('''
+                DELETE FROM commits_mat
+                WHERE (repo, sha) IN (
+                    SELECT repo, sha FROM commits_mat_pending
+                )
+            ''')
+            conn.execute('''
+                INSERT INTO commits_mat (
+                    repo, sha, time, message, status, perplexity
+                )
+                SELECT c.repo, c.sha, c.time, c.message, s.status,
+                       p.perplexity
+                FROM
+                    commits_mat_pending AS n
+                    JOIN commits_raw AS c USING (repo, sha)
+                    JOIN status_check AS s USING (repo, sha)
+                    JOIN perplexity AS p USING (repo, sha)
+                WHERE
+                    s.status IS NOT 'cancelled'
+            ''')
+        count_processed(conn, pending_only=not (full or never_refreshed))
+        conn.execute('DELETE FROM commits_mat_pending')
+        conn.execute('''
+            INSERT OR REPLACE INTO materialized (name, refreshed)
+            VALUES ('commits_mat', CURRENT_TIMESTAMP)
+        ''')
 
 
 def unescape_message(text):
@@ -254,62 +945,274 @@ def unescape_message(text):
         .replace('\\\\', '\\')
 
 
-def insert_commits_raw(repo, sha, time_str, message):
+def parse_commit_raw(repo, sha, time_str, message):
+    """
+    Converts a row of Boa's CSV output to the arguments of insert_commit().
+    """
     time = datetime.fromtimestamp(int(time_str) // 10**6)
-    return insert_commit(repo,
-                         sha,
-                         time,
-                         unescape_message(message))
+    return repo, sha, time, unescape_message(message)
+
+
+def insert_commits_raw(repo, sha, time_str, message):
+    return insert_commit(*parse_commit_raw(repo, sha, time_str, message))
 
 
-def fetch_raw_commits(exclude_repositories=()):
+def parse_commit_raw_checked(*row):
+    commit = parse_commit_raw(*row)
+    check_commit(*commit)
+    return commit
+
+
+def key_list(keys):
     """
-    Yields all commits, with status and perplexity set to null.
+    Encodes the keys as one JSON parameter, for json_each(). Any number of
+    keys fits in a single parameter, without a temporary table.
+
+    >>> key_list(('a/b', 'c/d'))
+    '["a/b", "c/d"]'
     """
+    return json.dumps(list(keys))
 
-    query = r'''
-        SELECT repo, sha, time, message
-        FROM commits_raw
-    '''
+
+def fetch_raw_commits(exclude_repositories=(), valid_only=False,
+                      autogen=False, include_repositories=None, shas=None):
+    """
+    Yields all commits, with status and perplexity set to null. When
+    valid_only is True, only yields commits that are known to be valid (or
+    valid with autogenerated messages, when autogen is True).
+
+    Commits can also be filtered by any number of repositories to include
+    or exclude, or by SHA.
+    """
+    conn = connection()
+
+    joins = ''
+    conditions = []
+    parameters = {}
+
+    # Convert string to single value tuple.
+    if isinstance(exclude_repositories, str):
+        exclude_repositories = (exclude_repositories,)
+    if isinstance(include_repositories, str):
+        include_repositories = (include_repositories,)
+
+    # SQLite looks up the keys of IN (...) in commits_raw's indices,
+    # rather than scanning all commits.
+    if include_repositories is not None:
+        conditions.append('c.repo IN (SELECT value FROM json_each(:include))')
+        parameters['include'] = key_list(include_repositories)
+
+    if shas is not None:
+        conditions.append('c.sha IN (SELECT value FROM json_each(:shas))')
+        parameters['shas'] = key_list(shas)
+
+    if valid_only:
+        joins = '''
+            JOIN commit_flags AS f ON f.repo = c.repo AND f.sha = c.sha
+        '''
+        conditions.append(valid_only_clause('f', autogen))
 
     if exclude_repositories:
-        # Convert string to single value tuple.
-        if isinstance(exclude_repositories, str):
-            exclude_repositories = (exclude_repositories,)
-        placeholders = ', '.join(repeat('?', len(exclude_repositories)))
+        conditions.append(
+            'c.repo NOT IN (SELECT value FROM json_each(:exclude))')
+        parameters['exclude'] = key_list(exclude_repositories)
+
+    query = r'''
+        SELECT c.repo, c.sha, c.time, c.message
+        FROM commits_raw AS c
+        {joins}
+    '''.format(joins=joins)
+
+    if conditions:
         query = '''
             {query}
-            WHERE repo NOT IN ({placeholders})
+            WHERE {conditions}
         '''.format(query=query,
-                   placeholders=placeholders)
+                   conditions=' AND '.join(conditions))
 
-    for row in conn.execute(query, exclude_repositories):
-        yield Commit(repo=row[0], sha=row[1], time=row[2], message=row[3],
-                     status=None, perplexity=None)
+    for row in conn.execute(query, parameters):
+        yield Commit(repo=row[0], sha=row[1], time=row[2],
+                     message=row[3], status=None, perplexity=None)
 
 
-def fetch_commits(autogen=False):
+def fetch_commits(autogen=False, valid_only=False, lazy=False):
     """
-    Yields all fully-processed commits.
+    Yields all fully-processed commits. When valid_only is True, only
+    yields commits that are known to be valid. When lazy is True, yields
+    LazyCommits, which only load their messages when needed.
     """
+    conn = connection()
 
-    cursor = conn.execute(r'''
+    query = r'''
         SELECT
-            repo, sha, time, message, status, perplexity
+            repo, sha, time, {message}, status, perplexity
         FROM {view}
-    '''.format(view='commits_autogen' if autogen else 'commits'))
+    '''.format(view='commits_autogen' if autogen else 'commits_mat',
+               message='NULL' if lazy else 'message')
+
+    if valid_only:
+        query += '''
+            JOIN commit_flags AS f USING (repo, sha)
+            WHERE {valid}
+        '''.format(valid=valid_only_clause('f', autogen))
+
+    cursor = conn.execute(query)
+
+    if lazy:
+        messages = LazyMessages()
+        for row in messages.expect_rows(cursor):
+            yield LazyCommit(row[0], row[1], row[2], messages, row[4], row[5])
+        return
 
     for row in cursor:
         yield Commit(*row)
 
 
+class LazyMessages(object):
+    """
+    Loads the messages of the LazyCommits from one query. The first time any
+    of them is needed, the messages of every commit fetched so far are
+    loaded, a batch of commits per query; they are kept for as long as any
+    of those commits (or the query) are.
+    """
+
+    def __init__(self, batch_size=400):
+        # Two parameters per commit must fit in SQLite's variable limit.
+        assert 2 * batch_size <= 999
+        self.batch_size = batch_size
+        # Commits that were fetched, but not loaded yet.
+        self._pending = []
+        self._messages = {}
+        # Commits can be passed to other threads.
+        self._lock = threading.Lock()
+
+    def expect_rows(self, cursor):
+        """
+        Yields rows from the cursor, starting with (repo, sha), fetching a
+        batch at a time, so that loading one message loads the whole batch.
+        """
+        while True:
+            rows = cursor.fetchmany(self.batch_size)
+            if not rows:
+                return
+            with self._lock:
+                self._pending.extend((row[0], row[1]) for row in rows)
+            yield from rows
+
+    def __call__(self, repo, sha):
+        with self._lock:
+            if (repo, sha) not in self._messages:
+                self._load()
+            try:
+                return self._messages[repo, sha]
+            except KeyError:
+                raise KeyError(sha)
+
+    def _load(self):
+        conn = connection()
+        pending, self._pending = self._pending, []
+        for start in range(0, len(pending), self.batch_size):
+            keys = pending[start:start + self.batch_size]
+            # Join on the keys (rather than using IN) to look each one up by
+            # the primary key.
+            cursor = conn.execute('''
+                SELECT c.repo, c.sha, c.message
+                FROM
+                    (VALUES {}) AS k
+                    JOIN commits_raw AS c
+                        ON c.repo = k.column1 AND c.sha = k.column2
+            '''.format(', '.join(repeat('(?, ?)', len(keys)))),
+                tuple(itertools.chain.from_iterable(keys)))
+
+            for repo, sha, message in cursor:
+                self._messages[repo, sha] = message
+
+
+def fetch_commit_table(autogen=False):
+    """
+    Returns all fully-processed commits, as a compact CommitTable.
+    """
+    from commit_table import CommitTable
+    return CommitTable.from_commits(fetch_commits(autogen))
+
+
+def export_columns(directory, autogen=False):
+    """
+    Exports all fully-processed commits as memory-mappable NumPy columns;
+    see commit_table.load_columns(). Returns the number of commits.
+    """
+    from commit_table import save_columns
+    return save_columns(directory, fetch_commits(autogen, lazy=True))
+
+
+class RepositorySummary(namedtuple('RepositorySummary',
+                                     'name commits with_status processed '
+                                     'statuses perplexities perplexity_sum '
+                                     'perplexity_sum_sq')):
+    """
+    Totals for one repository: its number of raw commits, how many of them
+    have a status, how many are fully processed (as counted by the
+    repositories view, as of the last refresh_materialized()), how many of
+    each status it has, and the number, sum, and sum of squares of its
+    perplexities.
+
+    >>> summary = RepositorySummary('a/b', 3, 2, 2, {'passed': 2}, 2, 6.0,
+    ...                             20.0)
+    >>> summary.perplexity_mean, summary.perplexity_variance
+    (3.0, 1.0)
+    """
+    __slots__ = ()
+
+    @property
+    def perplexity_mean(self):
+        if not self.perplexities:
+            return None
+        return self.perplexity_sum / self.perplexities
+
+    @property
+    def perplexity_variance(self):
+        if not self.perplexities:
+            return None
+        mean = self.perplexity_mean
+        return max(self.perplexity_sum_sq / self.perplexities - mean * mean,
+                   0.0)
+
+
+def fetch_repository_summaries():
+    """
+    Yields a RepositorySummary for every repository, from the summary
+    tables; no commits are scanned.
+    """
+    conn = connection()
+
+    statuses = {}
+    for repo, status, count in conn.execute('''
+        SELECT repo, status, count
+        FROM repo_status_counts
+        WHERE count > 0
+    '''):
+        statuses.setdefault(repo, {})[status] = count
+
+    cursor = conn.execute('''
+        SELECT
+            repo, commits, with_status, processed,
+            perplexities, perplexity_sum, perplexity_sum_sq
+        FROM repo_summary
+    ''')
+    for repo, commits, with_status, processed, n, total, total_sq in cursor:
+        yield RepositorySummary(repo, commits, with_status, processed,
+                                statuses.get(repo, {}), n, total, total_sq)
+
+
 def fetch_elligible_repositories():
     """
-    Returns all elligble repositories.
+    Returns all elligble repositories: those with at least one commit with
+    a status.
     """
+    conn = connection()
 
     cursor = conn.execute(r'''
-        SELECT name FROM repositories_with_statuses
+        SELECT repo FROM repo_summary WHERE with_status > 0
     ''')
 
     for row in cursor:
@@ -317,13 +1220,31 @@ def fetch_elligible_repositories():
         yield row[0]
 
 
-def fetch_commits_by_repo(repo_name):
-    cursor = conn.execute(r'''
+def fetch_commits_by_repo(repo_name, valid_only=False, autogen=False,
+                          lazy=False):
+    conn = connection()
+    query = r'''
         SELECT
-            repo, sha, time, message
+            repo, sha, time, {message}
         FROM commits_raw
-        WHERE repo = :repo
-      ''', {'repo': repo_name})
+      '''.format(message='NULL' if lazy else 'message')
+
+    if valid_only:
+        query += '''
+            JOIN commit_flags AS f USING (repo, sha)
+            WHERE repo = :repo AND {valid}
+        '''.format(valid=valid_only_clause('f', autogen))
+    else:
+        query += 'WHERE repo = :repo'
+
+    cursor = conn.execute(query, {'repo': repo_name})
+
+    if lazy:
+        messages = LazyMessages()
+        for row in messages.expect_rows(cursor):
+            yield LazyCommit(repo=row[0], sha=row[1], time=row[2],
+                             message=messages, status=None, perplexity=None)
+        return
 
     for row in cursor:
         yield Commit(repo=row[0], sha=row[1], time=row[2], message=row[3],
@@ -331,6 +1252,7 @@ def fetch_commits_by_repo(repo_name):
 
 
 def set_project_langauge(repo, language):
+    conn = connection()
     with conn:
         conn.execute('''\
             INSERT INTO project_lang (repo, lang)
@@ -338,38 +1260,476 @@ def set_project_langauge(repo, language):
          ''', {'name': repo, 'iso': language})
 
 
-def do_insert_from_csv(insert, filename):
+def fetch_tokens_as_string(repo, sha):
+    """
+    Fetch the persisted tokens of a commit, as tokenized by the current
+    version of the tokenizer.
+    """
+    conn = connection()
+    cursor = conn.execute('''
+        SELECT tokens_as_string
+        FROM tokens
+        WHERE
+            repo = ? AND
+            sha = ? AND
+            tokenizer_version = ?
+    ''', (repo, sha, TOKENIZER_VERSION))
+
+    try:
+        return cursor.fetchone()[0]
+    except TypeError:
+        raise KeyError(sha)
+
+
+def fetch_many_tokens_as_string(keys, chunk=400):
+    """
+    Fetch the persisted tokens of many commits, given as (repo, sha), as
+    tokenized by the current version of the tokenizer, a chunk of commits
+    per query. Returns a dictionary of (repo, sha) to tokens_as_string of
+    the commits that have them.
+    """
+    # Two parameters per commit must fit in SQLite's variable limit.
+    assert 0 < chunk <= 499
+    conn = connection()
+    keys = list(keys)
+    tokens = {}
+
+    for start in range(0, len(keys), chunk):
+        some_keys = keys[start:start + chunk]
+        cursor = conn.execute('''
+            SELECT t.repo, t.sha, t.tokens_as_string
+            FROM
+                (VALUES {}) AS k
+                JOIN tokens AS t
+                    ON t.repo = k.column1 AND t.sha = k.column2
+            WHERE
+                t.tokenizer_version = ?
+        '''.format(', '.join(repeat('(?, ?)', len(some_keys)))),
+            tuple(itertools.chain.from_iterable(some_keys)) +
+            (TOKENIZER_VERSION,))
+        for repo, sha, tokens_as_string in cursor:
+            tokens[repo, sha] = tokens_as_string
+
+    return tokens
+
+
+def fetch_persisted_commits(keys, chunk=400):
+    """
+    Returns which of the given (repo, sha) are already persisted as raw
+    commits, as a set, a chunk of commits per query.
+    """
+    # Two parameters per commit must fit in SQLite's variable limit.
+    assert 0 < chunk <= 499
+    conn = connection()
+    keys = list(keys)
+    persisted = set()
+
+    for start in range(0, len(keys), chunk):
+        some_keys = keys[start:start + chunk]
+        persisted.update(conn.execute('''
+            SELECT c.repo, c.sha
+            FROM
+                (VALUES {}) AS k
+                JOIN commits_raw AS c
+                    ON c.repo = k.column1 AND c.sha = k.column2
+        '''.format(', '.join(repeat('(?, ?)', len(some_keys)))),
+            tuple(itertools.chain.from_iterable(some_keys))))
+
+    return persisted
+
+
+def iter_pages(query, parameters=(), page_size=10000):
+    """
+    Yields every row of a query, fetching one page of rows at a time, so
+    that no cursor is left open (e.g., while inserting).
+
+    The rows must start with (repo, sha), the query must be ordered by
+    them, and its last three parameters must be the last (repo, sha) seen
+    and the page size. For example:
+
+        WHERE (repo, sha) > (?, ?) ORDER BY repo, sha LIMIT ?
+    """
+    conn = connection()
+    last_key = ('', '')
+    while True:
+        page = conn.execute(query, tuple(parameters) + last_key +
+                            (page_size,)).fetchall()
+        if not page:
+            return
+        yield from page
+        last_key = tuple(page[-1][:2])
+
+
+def backfill_tokens(workers=None, batch_size=10000):
+    """
+    Tokenizes every raw commit that has not been tokenized by the current
+    version of the tokenizer, and deletes tokens from older versions.
+    """
+    from tqdm import tqdm
+
+    conn = connection()
+    with conn:
+        conn.execute('''
+            DELETE FROM tokens WHERE tokenizer_version IS NOT ?
+        ''', (TOKENIZER_VERSION,))
+
+    untokenized = iter_pages('''
+        SELECT c.repo, c.sha, c.message
+        FROM
+            commits_raw AS c
+            LEFT JOIN tokens AS t
+                ON t.repo = c.repo AND
+                   t.sha = c.sha AND
+                   t.tokenizer_version = ?
+        WHERE
+            t.sha IS NULL AND
+            (c.repo, c.sha) > (?, ?)
+        ORDER BY c.repo, c.sha
+        LIMIT ?
+    ''', (TOKENIZER_VERSION,), page_size=batch_size)
+
+    # Only the keys of the messages that are being tokenized are held here.
+    in_flight = deque()
+
+    def messages():
+        for repo, sha, message in untokenized:
+            in_flight.append((repo, sha))
+            yield message
+
+    rows = iter(tqdm((in_flight.popleft() + (TOKENIZER_VERSION,
+                                             ' '.join(tokens))
+                      for tokens in iter_tokenize_many(messages(), workers)),
+                     desc="Tokenizing"))
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        with conn:
+            conn.executemany('''
+                INSERT INTO tokens (
+                    repo, sha, tokenizer_version, tokens_as_string
+                ) VALUES (?, ?, ?, ?)
+            ''', batch)
+
+
+def fetch_language(repo, sha):
+    """
+    Fetch the persisted (lang, confidence) of a commit.
+    """
+    conn = connection()
+    cursor = conn.execute('''
+        SELECT lang, confidence
+        FROM commit_lang
+        WHERE
+            repo = ? AND
+            sha = ?
+    ''', (repo, sha))
+
+    row = cursor.fetchone()
+    if row is None:
+        raise KeyError(sha)
+    return tuple(row)
+
+
+def backfill_languages(workers=None, batch_size=10000):
+    """
+    Identifies the language of every raw commit without one, in parallel.
+    """
+    from tqdm import tqdm
+
+    conn = connection()
+    unclassified = iter_pages('''
+        SELECT c.repo, c.sha, c.time, c.message
+        FROM
+            commits_raw AS c
+            LEFT JOIN commit_lang AS l USING (repo, sha)
+        WHERE
+            l.lang IS NULL AND
+            (c.repo, c.sha) > (?, ?)
+        ORDER BY c.repo, c.sha
+        LIMIT ?
+    ''', page_size=batch_size)
+    commits = (Commit(repo=row[0], sha=row[1], time=row[2], message=row[3],
+                      status=None, perplexity=None)
+               for row in unclassified)
+
+    progress = tqdm(desc="Identifying languages")
+    with shared_pool(workers):
+        while True:
+            batch = list(itertools.islice(commits, batch_size))
+            if not batch:
+                break
+            # The query already found that none of them has a language.
+            languages = classify_languages(batch, workers=workers,
+                                           stored=False)
+            with conn:
+                conn.executemany('''
+                    INSERT INTO commit_lang (
+                        repo, sha, lang, confidence
+                    ) VALUES (?, ?, ?, ?)
+                ''', ((c.repo, c.sha) + tuple(language)
+                      for c, language in zip(batch, languages)))
+            progress.update(len(batch))
+    progress.close()
+
+
+def backfill_flags(workers=None, batch_size=10000):
+    """
+    Computes the flags of every raw commit without any, or with flags
+    computed by another version of the tokenizer or templates.
+    """
+    from tqdm import tqdm
+
+    conn = connection()
+    unflagged = iter_pages('''
+        SELECT c.repo, c.sha, c.time, c.message, s.status
+        FROM
+            commits_raw AS c
+            LEFT JOIN status_check AS s USING (repo, sha)
+            LEFT JOIN commit_flags AS f USING (repo, sha)
+        WHERE
+            ({current}) IS NOT 1 AND
+            (c.repo, c.sha) > (?, ?)
+        ORDER BY c.repo, c.sha
+        LIMIT ?
+    '''.format(current=current_flags_clause('f')), page_size=batch_size)
+    commits = (Commit(repo=row[0], sha=row[1], time=row[2], message=row[3],
+                      status=row[4], perplexity=None)
+               for row in unflagged)
+
+    progress = tqdm(desc="Flagging commits")
+    with shared_pool(workers):
+        while True:
+            batch = list(itertools.islice(commits, batch_size))
+            if not batch:
+                break
+            # Do the slow parts in parallel first.
+            prime_message_cache(batch, workers=workers)
+            classify_languages(batch, workers=workers)
+            with conn:
+                insert_flags(batch)
+            progress.update(len(batch))
+    progress.close()
+
+
+# For each CSV import mode: the table, its columns, and how to convert a CSV
+# row to their values.
+CSV_IMPORTS = {
+    'commit': ('commits_raw', ('repo', 'sha', 'time', 'message'),
+               parse_commit_raw_checked),
+    'status': ('status_check', ('repo', 'sha', 'status'),
+               lambda repo, sha, status: (repo, sha, status)),
+    'perplexity': ('perplexity', ('repo', 'sha', 'perplexity'),
+                   lambda repo, sha, perplexity: (repo, sha, perplexity)),
+}
+
+
+def read_csv(filename, byte_offset=0):
+    """
+    Yields every row of a CSV file, starting at the given byte offset, and
+    the byte offset right after it.
+    """
     import csv
     csv.field_size_limit(2**31)
 
-    with open(filename, 'r', encoding="UTF=8") as commits_file:
-        for row in tqdm(csv.reader(commits_file)):
-            insert(*row)
+    position = byte_offset
+
+    def lines(csv_file):
+        nonlocal position
+        for line in csv_file:
+            position += len(line)
+            yield line.decode('UTF-8')
+
+    with open(filename, 'rb') as csv_file:
+        csv_file.seek(byte_offset)
+        # The reader only reads as many lines as the next row needs.
+        for row in csv.reader(lines(csv_file)):
+            yield row, position
+
+
+def fetch_checkpoint(filename):
+    """
+    Returns the (byte_offset, row_number) right after the last row of the
+    file that was inserted, or (0, 0) if none were.
+    """
+    conn = connection()
+    row = conn.execute('''
+        SELECT byte_offset, row_number
+        FROM csv_checkpoint
+        WHERE filename = ?
+    ''', (os.path.abspath(filename),)).fetchone()
+    return tuple(row) if row else (0, 0)
+
+
+def save_checkpoint(filename, mode, byte_offset, row_number):
+    """
+    Records how far into the file rows have been inserted. Call it in the
+    same transaction as the inserts.
+    """
+    conn = connection()
+    conn.execute('''
+        INSERT OR REPLACE INTO csv_checkpoint (
+            filename, mode, byte_offset, row_number
+        ) VALUES (?, ?, ?, ?)
+    ''', (os.path.abspath(filename), mode, byte_offset, row_number))
+
+
+@contextmanager
+def bulk_load():
+    """
+    Makes loading lots of rows much faster: uses a write-ahead log, stops
+    waiting for the disk after every transaction, and drops the secondary
+    indexes, rebuilding them at the end. If the machine crashes while
+    loading, the database may be corrupted!
+    """
+    conn = connection()
+    indexes = conn.execute('''
+        SELECT name, sql FROM sqlite_master
+        WHERE type = 'index' AND sql IS NOT NULL
+    ''').fetchall()
+    journal_mode, = conn.execute('PRAGMA journal_mode').fetchone()
+    synchronous, = conn.execute('PRAGMA synchronous').fetchone()
+
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = OFF')
+    with conn:
+        for name, _sql in indexes:
+            conn.execute('DROP INDEX {}'.format(name))
+    try:
+        yield
+    finally:
+        with conn:
+            for _name, sql in indexes:
+                conn.execute(sql)
+        conn.execute('PRAGMA synchronous = {:d}'.format(synchronous))
+        conn.execute('PRAGMA journal_mode = {}'.format(journal_mode))
+
+
+def insert_from_csv(mode, filename, resume=False, bulk=False,
+                    on_conflict=None, batch_size=None, workers=None):
+    """
+    Inserts every row of a CSV file, a batch of rows per transaction. The
+    same transaction records the checkpoint, so with resume, it starts
+    right after the last batch that was committed. Rows that are already
+    persisted are handled according to on_conflict (see ON_CONFLICT).
+
+    In bulk mode, the batches are bigger, the database is in bulk_load()
+    mode, and the flags of new commits are computed once all of the commits
+    are inserted.
+    """
+    from tqdm import tqdm
+
+    table, columns, parse = CSV_IMPORTS[mode]
+    query = '{insert} ({columns}) VALUES ({placeholders})'.format(
+        insert=insert_or(table, on_conflict),
+        columns=', '.join(columns),
+        placeholders=', '.join(repeat('?', len(columns))))
+    if batch_size is None:
+        batch_size = 50000 if bulk else 1000
+    byte_offset, row_number = fetch_checkpoint(filename) if resume else (0, 0)
+    # Flags are computed with each batch, unless loading in bulk; and, unless
+    # rows are replaced, only for the commits that aren't persisted yet.
+    flag_commits = mode == 'commit' and not bulk
+    new_only = (on_conflict or ON_CONFLICT.get(table, 'abort')) != 'replace'
+
+    conn = connection()
+    # Rows read, and rows actually inserted (or replaced).
+    read = inserted = 0
+    start = perf_counter()
+
+    with bulk_load() if bulk else nullcontext(), shared_pool(workers):
+        rows = iter(tqdm(read_csv(filename, byte_offset)))
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            values = [parse(*row) for row, _ in batch]
+            byte_offset = batch[-1][1]
+            row_number += len(batch)
+
+            if flag_commits:
+                commits = [Commit(repo=repo, sha=sha, time=time,
+                                  message=message, status=None,
+                                  perplexity=None)
+                           for repo, sha, time, message in values]
+                if new_only:
+                    persisted = fetch_persisted_commits(
+                        (commit.repo, commit.sha) for commit in commits)
+                    commits = [commit for commit in commits
+                               if (commit.repo, commit.sha) not in persisted]
+                # Do the slow parts in parallel first. Nothing is persisted
+                # about new commits yet.
+                prime_message_cache(commits, workers=workers,
+                                    stored=not new_only)
+                classify_languages(commits, workers=workers,
+                                   stored=not new_only)
+
+            with conn:
+                # Ignored rows don't count as changes.
+                inserted += conn.executemany(query, values).rowcount
+                if flag_commits:
+                    insert_flags(commits)
+                save_checkpoint(filename, mode, byte_offset, row_number)
+            read += len(batch)
+
+        if mode == 'commit' and bulk:
+            backfill_flags(workers=workers)
+        refresh_materialized()
+
+    elapsed = perf_counter() - start
+    print('Inserted {:,d} of {:,d} rows in {:.1f}s ({:,.0f} rows/s)'.format(
+        inserted, read, elapsed, read / elapsed if elapsed else 0.0),
+        file=sys.stderr)
+    return inserted
+
+
+# Commits look for their persisted tokens and languages here first.
+commit.set_token_store(fetch_tokens_as_string, fetch_many_tokens_as_string)
+commit.set_language_store(fetch_language)
 
 
 if __name__ == '__main__':
-    import sys
-
-    _, mode, argument = sys.argv
-    insert = None
-    lookup = None
-
-    if mode == 'commit':
-        insert = insert_commits_raw
-    elif mode == 'status':
-        insert = insert_status
-    elif mode == 'perplexity':
-        insert = insert_perplexity
-    elif mode == 'lookup-sha':
-        lookup = 'sha'
-    else:
-        print('[mode] must be lookup-sha, commit, status, or perplexity',
+    init_db()
+
+    _, mode, *arguments = sys.argv
+    # Options look like --bulk, or --on-conflict=ignore.
+    options = dict(a[2:].partition('=')[::2]
+                   for a in arguments if a.startswith('--'))
+    arguments = [a for a in arguments if not a.startswith('--')]
+    argument = arguments[0] if arguments else None
+
+    if mode == 'backfill-tokens':
+        backfill_tokens(workers=int(argument) if argument else None)
+        sys.exit(0)
+    elif mode == 'classify-languages':
+        backfill_languages(workers=int(argument) if argument else None)
+        sys.exit(0)
+    elif mode == 'flag-commits':
+        backfill_flags(workers=int(argument) if argument else None)
+        sys.exit(0)
+    elif mode == 'refresh':
+        refresh_materialized(full='full' in options)
+        sys.exit(0)
+    elif mode == 'export':
+        rows = export_columns(argument or 'columns',
+                              autogen='autogen' in options)
+        print('Exported', rows, 'commits', file=sys.stderr)
+        sys.exit(0)
+    elif mode in CSV_IMPORTS:
+        insert_from_csv(mode, argument,
+                        resume='resume' in options,
+                        bulk='bulk' in options,
+                        on_conflict=options.get('on-conflict'))
+        sys.exit(0)
+    elif mode != 'lookup-sha':
+        print('[mode] must be lookup-sha, commit, status, perplexity, '
+              'backfill-tokens, classify-languages, flag-commits, '
+              'refresh [--full], or export [directory] [--autogen]; '
+              'commit, status, and perplexity accept --bulk, --resume, '
+              'and --on-conflict=abort|ignore|replace',
               file=sys.stderr)
         sys.exit(-1)
 
-    if insert is not None:
-        do_insert_from_csv(insert, argument)
-    else:
-        commit = fetch_commit_by_sha(argument)
-        print(commit)
-        print(commit.tokens_as_string)
+    commit = fetch_commit_by_sha(argument)
+    print(commit)
+    print(commit.tokens_as_string)
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# -*- encoding: UTF-8 -*-
+
+# Copyright 2016 Eddie Antonio Santos <easantos@ualberta.ca>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Checks the query plan of every query that persist issues, on a generated
+database, and reports how long each query takes. Fails if any query scans a
+whole table, unless scanning it is the point of the query.
+
+Usage:
+    query_plans.py [repositories [commits-per-repository]]
+
+>>> check_in_subprocess(repositories=5, commits_per_repository=20)
+0
+"""
+
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from hashlib import sha1
+
+
+# Queries issued by these persist functions scan these tables (by the name
+# they have in the plan) on purpose.
+FULL_SCANS = {
+    'fetch_raw_commits': {'c'},
+    'fetch_raw_commits(exclude_repositories)': {'c'},
+    'fetch_commits_by_shas': {'k'},
+    'fetch_many_tokens_as_string': {'k'},
+    'fetch_commits': {'commits_mat'},
+    'fetch_commits(lazy)': {'commits_mat', 'k'},
+    'fetch_commits(autogen)': {'c'},
+    'fetch_repository_summaries': {'repo_summary', 'repo_status_counts'},
+    'fetch_elligible_repositories': {'repo_summary'},
+    'refresh_materialized': {'n', 'commits_mat_pending'},
+    'refresh_materialized(full)': {'c', 'repo_summary'},
+    'rebuild_summaries': {'c', 'perplexity', 'status_check', 'repo_summary'},
+    'backfill_tokens': {'tokens'},
+}
+
+# Plan steps that look like scans, but are not scans of a table.
+NOT_TABLES = re.compile(r'CONSTANT ROW|VALUES CLAUSE|\(subquery-\d+\)|'
+                        r'json_each|sqlite_master|sqlite_schema')
+
+STATUSES = ('passed', 'failed', 'errored', 'canceled')
+
+
+def generate(conn, repositories=1000, commits_per_repository=200, seed=2016):
+    """
+    Fills an empty database with random, but plausible, data.
+    """
+    from persist import FLAGS_VERSION, TOKENIZER_VERSION
+
+    generator = random.Random(seed)
+    start = datetime(2016, 1, 1)
+    words = ('fix', 'add', 'update', 'remove', 'typo', 'tests', 'readme',
+             'bug', 'merge', 'branch', 'version', 'docs', 'build')
+
+    commits = []
+    for repo_id in range(repositories):
+        repo = 'owner{0}/project{0}'.format(repo_id)
+        for commit_id in range(commits_per_repository):
+            sha = sha1('{}:{}'.format(repo, commit_id).encode()).hexdigest()
+            message = ' '.join(generator.choice(words)
+                               for _ in range(generator.randint(1, 12)))
+            time = start + timedelta(minutes=generator.randint(0, 10**6))
+            commits.append((repo, sha, time, message))
+
+    with conn:
+        conn.executemany('''
+            INSERT INTO commits_raw (repo, sha, time, message)
+            VALUES (?, ?, ?, ?)
+        ''', commits)
+        conn.executemany('''
+            INSERT INTO status_check (repo, sha, status) VALUES (?, ?, ?)
+        ''', ((repo, sha, generator.choice(STATUSES))
+              for repo, sha, _, _ in commits))
+        conn.executemany('''
+            INSERT INTO perplexity (repo, sha, perplexity) VALUES (?, ?, ?)
+        ''', ((repo, sha, generator.uniform(2, 2000))
+              for repo, sha, _, _ in commits))
+        conn.executemany('''
+            INSERT INTO perplexity_autogen (repo, sha, perplexity)
+            VALUES (?, ?, ?)
+        ''', ((repo, sha, generator.uniform(2, 2000))
+              for repo, sha, _, _ in commits))
+        conn.executemany('''
+            INSERT INTO commit_flags (repo, sha, flags, flags_version)
+            VALUES (?, ?, ?, ?)
+        ''', ((repo, sha, generator.choice((0, 4, 16, 18)), FLAGS_VERSION)
+              for repo, sha, _, _ in commits))
+        conn.executemany('''
+            INSERT INTO commit_lang (repo, sha, lang, confidence)
+            VALUES (?, ?, 'en', 0.9)
+        ''', ((repo, sha) for repo, sha, _, _ in commits))
+        conn.executemany('''
+            INSERT INTO tokens (repo, sha, tokenizer_version, tokens_as_string)
+            VALUES (?, ?, ?, ?)
+        ''', ((repo, sha, TOKENIZER_VERSION, message)
+              for repo, sha, _, message in commits))
+        conn.executemany('''
+            INSERT INTO project_lang (repo, lang) VALUES (?, ?)
+        ''', (('owner{0}/project{0}'.format(repo_id),
+               generator.choice(('en', 'en', 'en', 'de')))
+              for repo_id in range(repositories)))
+    conn.execute('ANALYZE')
+
+
+def workload(conn):
+    """
+    Yields (name, function) for every query persist issues.
+    """
+    import persist
+    import leave_one_out_ngram
+
+    repo, sha = conn.execute('''
+        SELECT repo, sha FROM commits_mat ORDER BY sha LIMIT 1
+    ''').fetchone()
+    new_sha = sha1(b'new commit').hexdigest()
+    repositories = [row[0] for row in conn.execute('''
+        SELECT repo FROM repo_summary ORDER BY repo
+    ''')]
+    shas = [row[0] for row in conn.execute('''
+        SELECT sha FROM commits_raw ORDER BY sha LIMIT 100
+    ''')]
+
+    def lazy_messages():
+        for commit in persist.fetch_commits(lazy=True):
+            commit.message
+
+    yield 'insert_commit', lambda: persist.insert_commit(
+        repo, new_sha, datetime(2016, 6, 1), 'Add a new commit')
+    yield 'insert_status', lambda: persist.insert_status(
+        repo, new_sha, 'passed')
+    yield 'insert_perplexity', lambda: persist.insert_perplexity(
+        repo, new_sha, 100.0)
+    yield 'refresh_materialized', persist.refresh_materialized
+    yield 'fetch_commit', lambda: persist.fetch_commit(repo, sha)
+    yield 'fetch_commit_by_sha', lambda: persist.fetch_commit_by_sha(sha)
+    yield 'fetch_commits_by_shas', lambda: persist.fetch_commits_by_shas(
+        shas + [new_sha])
+    yield 'fetch_tokens_as_string', lambda: persist.fetch_tokens_as_string(
+        repo, sha)
+    yield 'fetch_many_tokens_as_string', lambda: (
+        persist.fetch_many_tokens_as_string(
+            [(repo, sha) for repo in repositories[:10] for sha in shas]))
+    yield 'fetch_language', lambda: persist.fetch_language(repo, sha)
+    yield 'fetch_commits_by_repo', lambda: list(
+        persist.fetch_commits_by_repo(repo))
+    yield 'fetch_commits_by_repo(valid_only)', lambda: list(
+        persist.fetch_commits_by_repo(repo, valid_only=True))
+    yield 'fetch_raw_commits', lambda: list(persist.fetch_raw_commits())
+    yield 'fetch_raw_commits(exclude_repositories)', lambda: list(
+        persist.fetch_raw_commits(exclude_repositories=(repo,)))
+    yield 'fetch_raw_commits(valid_only)', lambda: list(
+        persist.fetch_raw_commits(valid_only=True))
+    yield 'fetch_raw_commits(include_repositories)', lambda: list(
+        persist.fetch_raw_commits(include_repositories=repositories[:10]))
+    yield 'fetch_raw_commits(shas)', lambda: list(
+        persist.fetch_raw_commits(shas=shas))
+    yield 'fetch_raw_commits(include_repositories, shas)', lambda: list(
+        persist.fetch_raw_commits(include_repositories=repositories,
+                                  shas=shas))
+    yield 'fetch_commits', lambda: list(persist.fetch_commits())
+    yield 'fetch_commits(valid_only)', lambda: list(
+        persist.fetch_commits(valid_only=True))
+    yield 'fetch_commits(autogen)', lambda: list(
+        persist.fetch_commits(autogen=True))
+    yield 'fetch_commits(lazy)', lazy_messages
+    yield 'fetch_repository_summaries', lambda: list(
+        persist.fetch_repository_summaries())
+    yield 'fetch_elligible_repositories', lambda: list(
+        persist.fetch_elligible_repositories())
+    yield 'leave_one_out_ngram.load_commits_by_repo', lambda: (
+        leave_one_out_ngram.load_commits_by_repo(tempfile.TemporaryFile()))
+    yield 'backfill_tokens', persist.backfill_tokens
+    yield 'refresh_materialized(full)', lambda: persist.refresh_materialized(
+        full=True)
+    yield 'rebuild_summaries', persist.rebuild_summaries
+
+
+def scanned_tables(conn, sql):
+    """
+    Yields the name of every table (or alias) that the statement scans.
+    """
+    for _id, _parent, _unused, detail in conn.execute(
+            'EXPLAIN QUERY PLAN ' + sql):
+        match = re.match(r'SCAN (?:TABLE )?(\S+)', detail)
+        if match and not NOT_TABLES.search(detail):
+            yield match.group(1)
+
+
+def check(conn):
+    """
+    Runs the workload, and checks the plan of every statement. Returns the
+    number of statements that scan a table they shouldn't.
+    """
+    statements = []
+    conn.set_trace_callback(statements.append)
+    failures = 0
+
+    for name, function in workload(conn):
+        del statements[:]
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+
+        allowed = FULL_SCANS.get(name, set())
+        queries = set(s for s in statements
+                      if re.match(r'\s*(SELECT|INSERT|UPDATE|DELETE|WITH)',
+                                  s, re.IGNORECASE))
+        scans = set()
+        for sql in queries:
+            scans.update(table for table in scanned_tables(conn, sql)
+                         if table not in allowed)
+
+        print('{:>46}: {:9.3f}s {}'.format(
+            name, elapsed, 'SCAN ' + ', '.join(sorted(scans))
+            if scans else 'ok'))
+        failures += bool(scans)
+
+    conn.set_trace_callback(None)
+    return failures
+
+
+def main(repositories=1000, commits_per_repository=200):
+    # Never touch the real database: persist must use a new one.
+    assert 'persist' not in sys.modules
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ['COMMIT_DATABASE'] = os.path.join(directory,
+                                                     'commits.sqlite')
+        import persist
+
+        persist.init_db()
+        conn = persist.connection()
+        generate(conn, repositories, commits_per_repository)
+        persist.refresh_materialized(full=True)
+        failures = check(conn)
+        conn.close()
+    return 1 if failures else 0
+
+
+def check_in_subprocess(repositories, commits_per_repository):
+    """
+    Runs the check in a new process; returns its exit status.
+    """
+    return subprocess.call(
+        [sys.executable, os.path.abspath(__file__),
+         str(repositories), str(commits_per_repository)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+if __name__ == '__main__':
+    sys.exit(main(*(int(argument) for argument in sys.argv[1:])))
@@ -18,17 +18,28 @@
 Tokenize files
 """
 
+import hashlib
+import os
 import re
 import regex
 import unicodedata
 import itertools
 
+from cache import LRUCache
+from parallel import DEFAULT_CHUNKSIZE, parallel_map
+
 try:
     from urllib.parse import urlparse
 except ImportError:
     from urlparse import urlparse
 
 
+SHA = re.compile(r'''
+    (?=[a-f]*\d)       # At least one digit...
+    [a-f0-9]{5,40}$
+''', re.VERBOSE)
+
+
 def is_sha(text):
     """
     To be considered a SHA, it must have at least one digit.
@@ -51,9 +62,17 @@ def is_sha(text):
     False
     """
 
-    valid_sha = bool(re.match(r'''^[a-f0-9]{5,40}$''', text))
-    has_digit = bool(re.search(r'\d', text))
-    return valid_sha and has_digit
+    return bool(SHA.match(text))
+
+
+BRACKETED_EMAIL = re.compile(r'''
+    <
+        [.\w]+          # User
+        @
+        (?:[\w]+[.])+   #
+        \w+             # TLD
+    >
+''', re.VERBOSE)
 
 
 def is_bracketed_email(text):
@@ -72,14 +91,16 @@ def is_bracketed_email(text):
     False
     """
 
-    return bool(re.match(r'''
-        <
-            [.\w]+          # User
-            @
-            (?:[\w]+[.])+   #
-            \w+             # TLD
-        >
-    ''', text, re.VERBOSE))
+    return bool(BRACKETED_EMAIL.match(text))
+
+
+PROJECT_ISSUE = re.compile(r'''
+    (?!utf-)    # Some special cases...
+    (?!latin-)
+    (?!iso-)
+
+    \w+-\d+$
+''', re.VERBOSE | re.UNICODE)
 
 
 def is_project_issue(text):
@@ -107,13 +128,14 @@ def is_project_issue(text):
     False
     """
 
-    return bool(re.match(r'''
-        (?!utf-)    # Some special cases...
-        (?!latin-)
-        (?!iso-)
+    return bool(PROJECT_ISSUE.match(text))
+
 
-        \w+-\d+$
-    ''', text, re.VERBOSE | re.UNICODE))
+ISSUE = re.compile(r'''
+    (?: (?:[\w.-]+/)?   # Owner
+           [\w.-]+)?    # Repository
+    [#]\d+$             # Issue number
+''', re.VERBOSE | re.UNICODE)
 
 
 def is_issue(text):
@@ -134,11 +156,16 @@ def is_issue(text):
     >>> is_issue('jlord/sheetsee.js#26')
     True
     """
-    return bool(re.match(r'''
-        (?: (?:[\w.-]+/)?   # Owner
-               [\w.-]+)?    # Repository
-        [#]\d+$             # Issue number
-    ''', text, re.VERBOSE | re.UNICODE))
+    return bool(ISSUE.match(text))
+
+
+VERSION_NUMBER = re.compile(r'''
+    v?
+    \d+              # Major number
+    (?: [.] \d+)?    # Minor number
+        [.] \d+      # Patch number
+    (?: [\-.](?:\w+|rc[.]?\d+))*  # Tag
+''', re.VERBOSE | re.IGNORECASE)
 
 
 def is_version_number(text):
@@ -167,17 +194,22 @@ def is_version_number(text):
     >>> is_version_number('0.1-SNAPSHOT')
     True
     """
-    return bool(re.match(r'''
-        v?
-        \d+              # Major number
-        (?: [.] \d+)?    # Minor number
-            [.] \d+      # Patch number
-        (?: [\-.](?:\w+|rc[.]?\d+))*  # Tag
-    ''', text, re.VERBOSE | re.IGNORECASE))
+    return bool(VERSION_NUMBER.match(text))
 
 
 # I realize now that I'm only supposed to cover Java syntaxes...
 # ...but I'm still tempted to match erlang:syntax/0
+METHOD_NAME = re.compile(r'''
+    (?:\w+(?:[.]|::))*  # Zero or more C++/Ruby namespaces
+    \w+
+    (?:
+        [(][)]          # A standard function
+     |
+        [#]\w+(?:[(][)])? # A Ruby Method
+    )
+''', re.VERBOSE)
+
+
 def is_method_name(text):
     """
     >>> is_method_name('hello')
@@ -194,15 +226,12 @@ def is_method_name(text):
     False
     """
 
-    return bool(re.match(r'''
-        (?:\w+(?:[.]|::))*  # Zero or more C++/Ruby namespaces
-        \w+
-        (?:
-            [(][)]          # A standard function
-         |
-            [#]\w+(?:[(][)])? # A Ruby Method
-        )
-    ''', text, re.VERBOSE))
+    return bool(METHOD_NAME.match(text))
+
+
+BUILD_VERSION = re.compile(r'''
+    \d+-\d+
+''', re.VERBOSE)
 
 
 def is_build_version(text):
@@ -213,9 +242,18 @@ def is_build_version(text):
     False
     """
 
-    return bool(re.match(r'''
-        \d+-\d+
-    ''', text, re.VERBOSE))
+    return bool(BUILD_VERSION.match(text))
+
+
+UUID = re.compile(r'''
+    # https://tools.ietf.org/html/rfc4122#section-3
+    [a-f0-9]{8}  -   # time-low
+    [a-f0-9]{4}  -   # time-mid
+    [a-f0-9]{4}  -   # time-high-and-version
+    [a-f0-9]{4}  -   # clock-seq-and-reserved clock-seq-low
+    [a-f0-9]{12}     # node
+    $
+''', re.VERBOSE)
 
 
 def is_uuid(text):
@@ -228,15 +266,17 @@ def is_uuid(text):
     False
     """
 
-    return bool(re.match(r'''
-        # https://tools.ietf.org/html/rfc4122#section-3
-        [a-f0-9]{8}  -   # time-low
-        [a-f0-9]{4}  -   # time-mid
-        [a-f0-9]{4}  -   # time-high-and-version
-        [a-f0-9]{4}  -   # clock-seq-and-reserved clock-seq-low
-        [a-f0-9]{12}     # node
-        $
-    ''', text, re.VERBOSE))
+    return bool(UUID.match(text))
+
+
+RELEASE_IDENTIFIER = re.compile(r'''
+    [\w\-_]+
+    # Copy-pasted is_version_number() regex
+    \d+              # Major number
+    (?: [.] \d+)?    # Minor number
+        [.] \d+      # Patch number
+    (?: [\-.](?:\w+|rc[.]?\d+))*  # Tag
+''', re.VERBOSE)
 
 
 def is_release_identifier(text):
@@ -249,14 +289,7 @@ def is_release_identifier(text):
     True
     """
 
-    return bool(re.match(r'''
-        [\w\-_]+
-        # Copy-pasted is_version_number() regex
-        \d+              # Major number
-        (?: [.] \d+)?    # Minor number
-            [.] \d+      # Patch number
-        (?: [\-.](?:\w+|rc[.]?\d+))*  # Tag
-    ''', text, re.VERBOSE))
+    return bool(RELEASE_IDENTIFIER.match(text))
 
 
 def is_url(text):
@@ -294,6 +327,16 @@ def is_url(text):
     return True
 
 
+FILE_PATTERN = re.compile(r'''
+    (?: [.]{0,2}[\-_*\w+]+ /)*  # Preceeding directories, if any
+        [.]?[\-_*\w+]+          # The basename
+
+    (?: [.][\-_*\w]+            # An extension
+      | [.][{][^}*,]+,[^}*]+[}] # An alternation
+      | (?: file | ignore ))    # .gitignore, Makefile
+''', re.VERBOSE | re.UNICODE)
+
+
 def is_file_pattern(text):
     """
     >>> is_file_pattern('file.java')
@@ -315,14 +358,30 @@ def is_file_pattern(text):
     >>> is_file_pattern('Class.{h,cpp}')
     True
     """
-    return bool(re.match(r'''
-        (?: [.]{0,2}[\-_*\w+]+ /)*  # Preceeding directories, if any
-            [.]?[\-_*\w+]+          # The basename
+    return bool(FILE_PATTERN.match(text))
+
+
+# Punctuation, according to clean_token_unicode()
+ALL_PUNCTUATION = regex.compile(r'^(?V1)[\p{Pi}\p{Ps}]+[\p{Pe}\p{Po}]+$')
+LEADING_PUNCTUATION = regex.compile(r'^(?V1)[`\p{Pi}\p{Ps}\p{Po}--*#]+')
+TRAILING_PUNCTUATION = regex.compile(r'(?V1)[`\p{Pe}\p{Po}--*#]+$')
+
+
+def _ascii_characters(pattern):
+    """
+    Returns every ASCII character matched by the (character class) pattern.
+    """
+    return ''.join(c for c in map(chr, range(128))
+                   if pattern.search(c))
+
 
-        (?: [.][\-_*\w]+            # An extension
-          | [.][{][^}*,]+,[^}*]+[}] # An alternation
-          | (?: file | ignore ))    # .gitignore, Makefile
-    ''', text, re.VERBOSE | re.UNICODE))
+# The same character classes, precomputed for ASCII-only tokens.
+ASCII_OPENING = _ascii_characters(regex.compile(r'(?V1)[\p{Pi}\p{Ps}]'))
+ASCII_CLOSING = _ascii_characters(regex.compile(r'(?V1)[\p{Pe}\p{Po}]'))
+ASCII_LEADING = _ascii_characters(LEADING_PUNCTUATION)
+ASCII_TRAILING = _ascii_characters(TRAILING_PUNCTUATION)
+ASCII_ALL_PUNCTUATION = re.compile('[{}]+[{}]+$'.format(
+    re.escape(ASCII_OPENING), re.escape(ASCII_CLOSING)))
 
 
 def clean_token(token):
@@ -338,18 +397,42 @@ def clean_token(token):
     It returns tokens made entirely of punctuation as is.
     >>> clean_token('[...]')
     '[...]'
+
+    It cleans Unicode punctuation too:
+    >>> clean_token('(caf\u00e9)')
+    'caf\u00e9'
+    """
+
+    if not token.isascii():
+        return clean_token_unicode(token)
+
+    # Same as below, but with plain old string methods.
+    if ASCII_ALL_PUNCTUATION.match(token):
+        return token
+    return token.lstrip(ASCII_LEADING).rstrip(ASCII_TRAILING)
+
+
+def clean_token_unicode(token):
+    """
+    Cleans tokens with any characters at all.
+    >>> clean_token_unicode('\u00bfqu\u00e9?')
+    'qu\u00e9'
     """
 
     # If it's entirely punctuation, return it as is
-    if regex.match(r'^(?V1)[\p{Pi}\p{Ps}]+[\p{Pe}\p{Po}]+$', token):
+    if ALL_PUNCTUATION.match(token):
         return token
 
     # Remove surrounding parens, and initial quotations.
-    token = regex.sub(r'^(?V1)[`\p{Pi}\p{Ps}\p{Po}--*#]+', '', token)
-    return regex.sub(r'(?V1)[`\p{Pe}\p{Po}--*#]+$', '', token)
+    token = LEADING_PUNCTUATION.sub('', token)
+    return TRAILING_PUNCTUATION.sub('', token)
 
 
-def replace_special_token(dirty_token):
+def replace_special_token_by_predicates(dirty_token):
+    """
+    The original classifier: tries each predicate, one after the other.
+    Kept as the reference implementation for replace_special_token().
+    """
     # Do these two first...
     if is_method_name(dirty_token):
         return 'METHOD-NAME'
@@ -382,15 +465,143 @@ def replace_special_token(dirty_token):
         return token
 
 
+# Special token classes for cleaned tokens, in order of priority.
+# (METHOD-NAME is matched on the dirty token, so it is not in here).
+SPECIAL_TOKEN_PATTERNS = (
+    ('ISSUE-NUMBER', ISSUE),
+    ('UUID', UUID),
+    ('BUILD-VERSION', BUILD_VERSION),
+    ('PROJECT-ISSUE', PROJECT_ISSUE),
+    ('GIT-SHA', SHA),
+    ('EMAIL', BRACKETED_EMAIL),
+    ('RELEASE-IDENTIFIER', RELEASE_IDENTIFIER),
+    ('VERSION-NUMBER', VERSION_NUMBER),
+    # Only a prefilter: is_url() has the final say.
+    ('URL', re.compile(r'''
+        [\x00-\x20]*        # urlparse() strips leading control characters
+        (?: https? | svn )://
+    ''', re.VERBOSE | re.IGNORECASE)),
+    ('FILE-PATTERN', FILE_PATTERN),
+)
+
+SPECIAL_TOKENS = ('METHOD-NAME',) + tuple(name for name, _ in
+                                          SPECIAL_TOKEN_PATTERNS)
+
+
+def _compile_classifier(patterns):
+    """
+    Combines all patterns into one big alternation. Alternatives are tried
+    left-to-right, so the first named group that matches is the class of
+    highest priority.
+    """
+    alternatives = []
+    for name, pattern in patterns:
+        flags = 'i' if pattern.flags & re.IGNORECASE else ''
+        alternatives.append('(?P<{group}>(?{flags}:{pattern}\n))'.format(
+            group=name.replace('-', '_'),
+            flags=flags,
+            pattern=pattern.pattern))
+    return re.compile('|'.join(alternatives), re.VERBOSE | re.UNICODE)
+
+
+CLASSIFIER = _compile_classifier(SPECIAL_TOKEN_PATTERNS)
+
+
+def replace_special_token(dirty_token):
+    """
+    Replaces the token with its special class, if it has one; otherwise,
+    returns the cleaned token. Same as
+    replace_special_token_by_predicates(), but decides the class in a single
+    scan of the token.
+
+    >>> replace_special_token('#22')
+    'ISSUE-NUMBER'
+    >>> replace_special_token('13f79535-47bb-0310-9956-ffa450edef68')
+    'UUID'
+    >>> replace_special_token('http://[')
+    'http://['
+    >>> replace_special_token('(herp,')
+    'herp'
+    """
+    # Do these two first...
+    if METHOD_NAME.match(dirty_token):
+        return 'METHOD-NAME'
+
+    token = clean_token(dirty_token)
+    match = CLASSIFIER.match(token)
+    if match is None:
+        assert token.lower() == token
+        return token
+
+    special = match.lastgroup.replace('_', '-')
+    if special != 'URL' or is_url(token):
+        return special
+    # Looked like a URL, but it wasn't one. Do this one last...
+    elif FILE_PATTERN.match(token):
+        return 'FILE-PATTERN'
+    else:
+        assert token.lower() == token
+        return token
+
+
+# Bump this whenever a change to the code (rather than to the patterns)
+# changes how messages are tokenized.
+TOKENIZER_REVISION = 1
+
+
+def _tokenizer_version():
+    """
+    Any change to the tokenizer's patterns (including the special tokens and
+    their priority, in CLASSIFIER) or to TOKENIZER_REVISION changes this
+    version. Editing comments, docstrings, or other code doesn't.
+    """
+    digest = hashlib.sha1(str(TOKENIZER_REVISION).encode('UTF-8'))
+    for name, value in sorted(globals().items()):
+        if isinstance(value, (type(SHA), type(ALL_PUNCTUATION))):
+            digest.update('\n{}/{}/{}'.format(
+                name, value.flags, value.pattern).encode('UTF-8'))
+    return digest.hexdigest()[:16]
+
+
+# Identifies the output of this tokenizer, for persisted tokens.
+TOKENIZER_VERSION = _tokenizer_version()
+
+
+# Commit messages are very repetitive, so remember how tokens were replaced.
+# Set TOKEN_CACHE_SIZE=0 to disable.
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 2**16))
+_TOKEN_CACHE = LRUCache(maxsize=TOKEN_CACHE_SIZE)
+
+
+def configure_token_cache(maxsize=TOKEN_CACHE_SIZE):
+    """
+    Replaces the token cache with an empty one of the given size. A size of
+    zero disables the cache; None makes it unbounded.
+    """
+    global _TOKEN_CACHE
+    _TOKEN_CACHE = LRUCache(maxsize=maxsize)
+
+
+def token_cache_stats():
+    """
+    Returns the hits, misses, evictions, and size of the token cache.
+    """
+    return _TOKEN_CACHE.stats
+
+
 def clean_tokens(tokens):
     """
     Generates only cleaned tokens. Tokens made of only punctuation are
     completely removed.
     """
+    cache = _TOKEN_CACHE
     for token in tokens:
-        cleaned = replace_special_token(token)
         if len(token) == 0:
             continue
+        cleaned = cache.get(token)
+        if cleaned is None:
+            cleaned = replace_special_token(token)
+            cache[token] = cleaned
         yield cleaned
 
 
@@ -503,9 +714,11 @@ def tokenize(string):
     ['git-svn-id', 'URL', 'UUID']
     """
 
-    # Step 1: Normalize into NFC
+    # Step 1: Normalize into NFC (ASCII is always in NFC)
     # Step 2: Lowercase
-    ustring = unicodedata.normalize('NFC', string).lower()
+    if not string.isascii():
+        string = unicodedata.normalize('NFC', string)
+    ustring = string.lower()
 
     # Remove leading '-', '*', '#'
     cleaned = clean_front(ustring)
@@ -517,9 +730,37 @@ def tokenize(string):
     return list(clean_tokens(segments))
 
 
+def tokenize_many(messages, workers=None, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Tokenizes many messages on a pool of worker processes. Returns a list of
+    tokens for each message, in the same order as the messages.
+
+    >>> tokenize_many(['Fixed #22', 'Implement foobar()'], workers=1)
+    [['fixed', 'ISSUE-NUMBER'], ['implement', 'METHOD-NAME']]
+    """
+    return list(iter_tokenize_many(messages, workers=workers,
+                                   chunksize=chunksize))
+
+
+def iter_tokenize_many(messages, workers=None, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Like tokenize_many(), but yields the tokens of each message as soon as
+    its chunk is done, in order. Only a few chunks per worker are in flight
+    at any time, so messages may be a (very long) generator.
+
+    When workers is None, uses one worker per CPU. When workers is 1,
+    tokenizes in this process.
+    """
+    return parallel_map(tokenize, messages, workers=workers,
+                        chunksize=chunksize)
+
+
 if __name__ == '__main__':
     import doctest
     from blessings import Terminal
+
+    # Make sure every doctest goes through the whole tokenizer.
+    configure_token_cache(0)
     failures, tests = doctest.testmod()
 
     term = Terminal()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- encoding: UTF-8 -*-
+
+# Copyright 2016 Eddie Antonio Santos <easantos@ualberta.ca>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Interns tokens as dense integer IDs.
+
+Usage:
+    vocabulary.py
+
+Builds the vocabulary of every commit in the database, and saves it next to
+the database.
+"""
+
+import os
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from tokenize_commit import SPECIAL_TOKENS, tokenize
+
+
+# Typecode for token IDs: unsigned 32-bit (on every platform we care about).
+TYPECODE = 'I'
+
+
+class Vocabulary(object):
+    """
+    Maps tokens to dense integer IDs, and back again. The special token
+    classes always have the same IDs, in order, starting at zero.
+
+    >>> vocab = Vocabulary()
+    >>> vocab['METHOD-NAME']
+    0
+    >>> vocab['FILE-PATTERN'] == len(SPECIAL_TOKENS) - 1
+    True
+    >>> ids = vocab.tokenize('Fixed #22 in filename.py')
+    >>> ids
+    array('I', [11, 1, 12, 10])
+    >>> vocab.decode(ids)
+    ['fixed', 'ISSUE-NUMBER', 'in', 'FILE-PATTERN']
+    """
+
+    def __init__(self, tokens=()):
+        self._ids = {}
+        self._tokens = []
+        for token in SPECIAL_TOKENS:
+            self.add(token)
+        for token in tokens:
+            self.add(token)
+
+    def add(self, token):
+        """
+        Returns the ID of the token, interning it if it's new.
+        """
+        try:
+            return self._ids[token]
+        except KeyError:
+            token_id = len(self._tokens)
+            self._ids[token] = token_id
+            self._tokens.append(token)
+            return token_id
+
+    def token(self, token_id):
+        return self._tokens[token_id]
+
+    def encode(self, tokens, grow=True):
+        """
+        Returns the IDs of the given tokens as an array. Unless grow is
+        True, raises KeyError for unknown tokens.
+        """
+        lookup = self.add if grow else self._ids.__getitem__
+        return array(TYPECODE, (lookup(token) for token in tokens))
+
+    def decode(self, ids):
+        return [self._tokens[token_id] for token_id in ids]
+
+    def tokenize(self, message, grow=True, as_numpy=False):
+        """
+        Tokenizes the message into an array of token IDs, or a NumPy array
+        (sharing the same memory) if as_numpy is True.
+        """
+        ids = self.encode(tokenize(message), grow=grow)
+        if not as_numpy:
+            return ids
+        if numpy is None:
+            raise ImportError('as_numpy requires NumPy')
+        return numpy.frombuffer(ids, dtype=numpy.uint32)
+
+    def save(self, filename=None):
+        """
+        Saves the vocabulary as text; one token per line, in ID order.
+        """
+        if filename is None:
+            filename = default_filename()
+
+        temporary = filename + '.tmp'
+        with open(temporary, 'w', encoding='UTF-8') as vocab_file:
+            for token in self._tokens:
+                assert '\n' not in token
+                vocab_file.write(token)
+                vocab_file.write('\n')
+        os.replace(temporary, filename)
+
+    @classmethod
+    def load(cls, filename=None):
+        if filename is None:
+            filename = default_filename()
+
+        with open(filename, encoding='UTF-8', newline='\n') as vocab_file:
+            tokens = vocab_file.read().split('\n')
+        # Ignore the final newline.
+        assert tokens[-1] == ''
+        del tokens[-1]
+
+        if tuple(tokens[:len(SPECIAL_TOKENS)]) != SPECIAL_TOKENS:
+            raise ValueError('Special tokens in %r do not match the '
+                             'tokenizer' % (filename,))
+        if len(set(tokens)) != len(tokens):
+            raise ValueError('Duplicate tokens in %r' % (filename,))
+        return cls(tokens[len(SPECIAL_TOKENS):])
+
+    def __getitem__(self, token):
+        return self._ids[token]
+
+    def __contains__(self, token):
+        return token in self._ids
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def __iter__(self):
+        return iter(self._tokens)
+
+    def __repr__(self):
+        return '<{} size={}>'.format(self.__class__.__name__, len(self))
+
+
+def default_filename():
+    """
+    The vocabulary lives right next to the database.
+    """
+    from persist import FILENAME
+    return os.path.splitext(FILENAME)[0] + '.vocab'
+
+
+def load_vocabulary():
+    """
+    Loads the saved vocabulary, or an empty one if there is none.
+    """
+    try:
+        return Vocabulary.load()
+    except FileNotFoundError:
+        return Vocabulary()
+
+
+if __name__ == '__main__':
+    from tqdm import tqdm
+
+    import persist
+    from tokenize_commit import iter_tokenize_many
+
+    persist.init_db()
+    vocabulary = load_vocabulary()
+    messages = (commit.message for commit in persist.fetch_raw_commits())
+    for tokens in tqdm(iter_tokenize_many(messages), desc="Tokenizing"):
+        vocabulary.encode(tokens)
+
+    vocabulary.save()
+    print(vocabulary)